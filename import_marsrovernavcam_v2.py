@@ -1,15 +1,17 @@
 import bpy
 import os
-import subprocess
-import sys
 import math
 import mathutils
 from mathutils import Vector, Quaternion
-import struct
-import bmesh
-from urllib import request
+import numpy as np
+import mmap
+from urllib import parse, request
+import http.client
 import time
 import re
+import sqlite3
+import hashlib
+import base64
 from datetime import datetime
 
 
@@ -28,7 +30,7 @@ bl_info = {
     "name": "Mars Rover Multicam Import",
     "author": "Jumpjack (credits: Rob Haarsma)",
     "version": (0, 3, 2),
-    "blender": (2, 80, 0),
+    "blender": (2, 93, 0),
     "location": "File > Import > ...  and/or 3D Window Tools menu > Mars Rover Multicam Import",
     "description": "Creates Martian landscapes from Mars Rover Navcam/Pancam/Hazcam images",
     "warning": "This script produces high poly meshes and saves downloaded data in Temp directory",
@@ -50,6 +52,11 @@ local_data_dir = []
 local_file = []
 
 popup_error = None
+catalog_db = None
+catalog_path = None
+decoded_cache_half = False
+decoded_cache_compress = False
+decode_block_lines = 0
 curve_minval = None
 curve_maxval = None
 
@@ -67,14 +74,90 @@ class NavcamDialogOperator(bpy.types.Operator):
 
     navcam_string: bpy.props.StringProperty(name="Image Name", default='')
     fillhole_bool: bpy.props.BoolProperty(name="Fill Gaps (draft)", default = True)
-    #filllength_float: bpy.props.FloatProperty(name="Max Fill Length", min=0.001, max=100.0, default=0.6)
+    filldirection_enum: bpy.props.EnumProperty(name="Fill Direction", default='VERTICAL',
+        items=[('VERTICAL', "Vertical", "Bridge gaps along image columns"),
+               ('HORIZONTAL', "Horizontal", "Bridge gaps along image rows"),
+               ('BOTH', "Both", "Bridge gaps along columns, then rows")])
+    fillgap_int: bpy.props.IntProperty(name="Max Fill Gap (pixels, 0 = any)", min=0, max=4096, default=0)
+    filllength_float: bpy.props.FloatProperty(name="Max Fill Length (m)", min=0.001, max=1000.0, default=6.0)
+    resolution_enum: bpy.props.EnumProperty(name="Mesh Resolution", default='1',
+        items=[('1', "Full", "Use every XYZ sample"),
+               ('2', "1/2", "Use one XYZ sample in 2 in each direction"),
+               ('4', "1/4", "Use one XYZ sample in 4 in each direction"),
+               ('8', "1/8", "Use one XYZ sample in 8 in each direction")])
+    downsample_enum: bpy.props.EnumProperty(name="Downsampling", default='STRIDE',
+        items=[('STRIDE', "Stride", "Keep every n-th sample"),
+               ('AVERAGE', "Average", "Average the valid samples of each block")])
+    tolerance_float: bpy.props.FloatProperty(name="Adaptive Mesh Tolerance (m, 0 = off)", min=0.0, max=10.0, default=0.0)
+    maxrange_float: bpy.props.FloatProperty(name="Max Range (m, 0 = off)", min=0.0, max=1000.0, default=0.0)
+    maxedge_float: bpy.props.FloatProperty(name="Max Face Edge (m, 0 = off)", min=0.0, max=100.0, default=0.0)
+    depthratio_float: bpy.props.FloatProperty(name="Max Face Depth Ratio (0 = off)", min=0.0, max=100.0, default=0.0,
+        description="Drop faces whose farthest corner is this many times farther than the nearest; 0 = off, otherwise at least 1")
+    points_bool: bpy.props.BoolProperty(name="Points Only (no faces)")
+    intensity_bool: bpy.props.BoolProperty(name="Point Intensity from Texture")
+    mosaic_bool: bpy.props.BoolProperty(name="Merge Site Mosaic")
+    mosaicvoxel_float: bpy.props.FloatProperty(name="Mosaic Voxel Size (m)", min=0.001, max=10.0, default=0.05)
+    join_enum: bpy.props.EnumProperty(name="Join Products", default='NONE',
+        items=[('NONE', "None", "One object per product"),
+               ('SOL', "Per Sol", "One object per sol"),
+               ('SITE', "Per Site", "One object per rover site")])
+    dem_enum: bpy.props.EnumProperty(name="Site DEM", default='NONE',
+        items=[('NONE', "None", "Import the range image meshes"),
+               ('IMAGE', "Heightfield", "Float heightfield image and displaced plane per site"),
+               ('MESH', "Grid Mesh", "Regular grid mesh per site")])
+    demcell_float: bpy.props.FloatProperty(name="DEM Cell Size (m)", min=0.005, max=10.0, default=0.1)
+    demrule_enum: bpy.props.EnumProperty(name="DEM Cell Height", default='TOP',
+        items=[('TOP', "Highest", "Highest sample of the cell (z-buffer seen from above)"),
+               ('MEDIAN', "Median", "Median of the samples of the cell, estimated from 32 per cell when there are more")])
+    preview_bool: bpy.props.BoolProperty(name="Preview First, Then Refine")
+    previewres_enum: bpy.props.EnumProperty(name="Preview Resolution", default='8',
+        items=[('4', "1/4", "Use one XYZ sample in 4 in each direction"),
+               ('8', "1/8", "Use one XYZ sample in 8 in each direction"),
+               ('16', "1/16", "Use one XYZ sample in 16 in each direction")])
+    previewbudget_float: bpy.props.FloatProperty(name="Preview Time Budget (s)", min=0.0, max=600.0, default=10.0)
+    lodlevels_int: bpy.props.IntProperty(name="LOD Levels (0 = off)", min=0, max=4, default=0)
+    loddistance_float: bpy.props.FloatProperty(name="LOD Distance (m)", min=0.1, max=1000.0, default=20.0)
     radimage_bool: bpy.props.BoolProperty(name="Use 16bit RAD texture", default = False)
+    radstretch_float: bpy.props.FloatProperty(name="RAD Stretch Percentile", min=0.0, max=49.0, default=0.0)
+    radpng_bool: bpy.props.BoolProperty(name="Save RAD texture as PNG", default = False)
+    cachehalf_bool: bpy.props.BoolProperty(name="Cache decoded XYZ as float16", default = False)
+    cachecompress_bool: bpy.props.BoolProperty(name="Compress decoded XYZ cache", default = False)
+    blocklines_int: bpy.props.IntProperty(name="Decode Block Lines (0 = whole product)", min=0, max=4096, default=0,
+        description="Build meshes and points this many lines at a time; the adaptive mesh always decodes the whole product")
 
     def execute(self, context):
-        ReadNavcamString(self.navcam_string, self.fillhole_bool, self.radimage_bool)
+        ReadNavcamString(self.navcam_string, self.fillhole_bool, self.radimage_bool,
+                         self.radstretch_float, self.radpng_bool,
+                         self.cachehalf_bool, self.cachecompress_bool,
+                         inFillDirection=self.filldirection_enum, inFillGap=self.fillgap_int,
+                         inFillLength=self.filllength_float,
+                         inResolution=int(self.resolution_enum), inDownsample=self.downsample_enum,
+                         inTolerance=self.tolerance_float, inMaxRange=self.maxrange_float,
+                         inMaxEdge=self.maxedge_float, inDepthRatio=self.depthratio_float,
+                         inLodLevels=self.lodlevels_int, inLodDistance=self.loddistance_float,
+                         inPoints=self.points_bool, inPointIntensity=self.intensity_bool,
+                         inMosaic=self.mosaic_bool, inMosaicVoxel=self.mosaicvoxel_float,
+                         inJoin=self.join_enum, inDem=self.dem_enum, inDemCell=self.demcell_float,
+                         inDemRule=self.demrule_enum, inPreview=self.preview_bool,
+                         inPreviewResolution=int(self.previewres_enum), inPreviewBudget=self.previewbudget_float,
+                         inBlockLines=self.blocklines_int)
         # navcam_string: one or more image id, comma separated
         # fillhole_bool: flag to attempt filling holes
+        # filldirection_enum, fillgap_int, filllength_float: which holes get filled
+        # resolution_enum, downsample_enum: mesh resolution divider and how to downsample
+        # tolerance_float: error bound of the adaptive triangle mesh, 0 for a quad grid
+        # maxrange_float, maxedge_float, depthratio_float: far sample and occlusion edge rejection
+        # lodlevels_int, loddistance_float: coarser copies shown with distance from the camera
+        # points_bool, intensity_bool: vertex only point cloud, with texture intensity attribute
+        # mosaic_bool, mosaicvoxel_float: one deduplicated object per site
+        # join_enum: one object per sol or site instead of one per product
+        # dem_enum, demcell_float, demrule_enum: rasterize the products of each site into a DEM
+        # preview_bool, previewres_enum, previewbudget_float: coarse import first, refined afterwards
         # radimage_bool: flag to use 16 bit texture
+        # radstretch_float: percentile stretch of 16 bit texture
+        # radpng_bool: flag to save 16 bit texture as PNG
+        # cachehalf_bool, cachecompress_bool: storage of the decoded XYZ cache
+        # blocklines_int: lines per block of the streaming decode, bounds the peak memory
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -82,22 +165,73 @@ class NavcamDialogOperator(bpy.types.Operator):
         return wm.invoke_props_dialog(self, width=550)
 
 
-def ReadNavcamString(inString, inFillBool, inRadBool):
+def ReadNavcamString(inString, inFillBool, inRadBool, inRadStretch=0.0, inRadPng=False,
+                     inCacheHalf=False, inCacheCompress=False,
+                     inFillDirection='VERTICAL', inFillGap=0, inFillLength=6.0,
+                     inResolution=1, inDownsample='STRIDE', inTolerance=0.0,
+                     inMaxRange=0.0, inMaxEdge=0.0, inDepthRatio=0.0,
+                     inLodLevels=0, inLodDistance=20.0, inPoints=False, inPointIntensity=False,
+                     inMosaic=False, inMosaicVoxel=0.05, inJoin='NONE',
+                     inDem='NONE', inDemCell=0.1, inDemRule='TOP',
+                     inPreview=False, inPreviewResolution=8, inPreviewBudget=10.0, inBlockLines=0):
     # inString: one or more image id, comma separated
     # inFillBool: flag to attempt filling holes
     # inRadBool: flag to use 16 bit texture
+    # inRadStretch: percentile clipped at both ends of the 16 bit texture range (0 = min/max)
+    # inRadPng: flag to also save the 16 bit texture as PNG next to the RAD file
+    # inCacheHalf: flag to store decoded XYZ data as float16
+    # inCacheCompress: flag to compress decoded XYZ data
+    # inFillDirection: fill gaps along 'VERTICAL' columns, 'HORIZONTAL' rows or 'BOTH'
+    # inFillGap: longest gap to fill in pixels, 0 for any
+    # inFillLength: longest gap to fill in metres
+    # inResolution: mesh resolution divider, 1 for full resolution
+    # inDownsample: 'STRIDE' to skip samples, 'AVERAGE' to average blocks of samples
+    # inTolerance: max error in metres of an adaptive triangle mesh, 0 for the regular quad grid
+    # inMaxRange: drop samples farther than this from the rover origin, in metres, 0 for no limit
+    # inMaxEdge: drop faces with an edge longer than this, in metres, 0 for no limit
+    # inDepthRatio: drop faces whose farthest corner is this many times farther than the nearest, 0 for no limit,
+    #               otherwise at least 1
+    # inLodLevels: number of coarser levels of detail per product, 0 for none
+    # inLodDistance: camera distance in metres beyond which the first coarser level is shown
+    # inPoints: import the valid xyz samples as a vertex only mesh (no fill, faces, uvs or material)
+    # inPointIntensity: add a per point 'intensity' attribute sampled from the texture
+    # inMosaic: merge the products of each site into one object, dropping overlaps
+    # inMosaicVoxel: voxel size in metres of the mosaic overlap test
+    # inJoin: 'SOL' or 'SITE' to join the products into one object per sol or site, 'NONE' for one object each
+    # inDem: 'IMAGE' for a heightfield image and displaced plane per site, 'MESH' for a grid mesh, 'NONE' for off
+    # inDemCell: DEM cell size in metres
+    # inDemRule: height of a DEM cell with several samples, 'TOP' for the highest or 'MEDIAN'
+    # inPreview: import a coarse mesh with the browse texture first, upgraded in place afterwards
+    # inPreviewResolution: mesh resolution divider of the previews
+    # inPreviewBudget: seconds spent on previews, later products are only imported at full resolution
+    # inBlockLines: decode and mesh XYZ products this many lines at a time, 0 for the whole product at once
 
     global local_data_dir, roverDataDir, roverImageDir, popup_error, curve_minval, curve_maxval
+    global decoded_cache_half, decoded_cache_compress, decode_block_lines
 
     if inString=="": return
 
+    # below 1 every face would go
+    if 0.0 < inDepthRatio < 1.0:
+        print('Max face depth ratio %g ignored, it is 0 (off) or at least 1' %(inDepthRatio))
+        inDepthRatio = 0.0
+
+    geometry = {'fill_direction': inFillDirection, 'fill_gap': inFillGap, 'fill_length': inFillLength,
+                'resolution': max(1, int(inResolution)), 'downsample': inDownsample,
+                'tolerance': inTolerance, 'max_range': inMaxRange, 'max_edge': inMaxEdge,
+                'max_depth_ratio': inDepthRatio, 'points': bool(inPoints)}
 
     time_start = time.time()
 
+    decoded_cache_half = inCacheHalf
+    decoded_cache_compress = inCacheCompress
+    decode_block_lines = max(0, int(inBlockLines))
+
     SetRenderSettings()
     local_data_dir = os.path.join(bpy.context.preferences.filepaths.temporary_directory, 'MarsRoverImages/')
 
     collString = inString.split(",") # Divide multiple image ids into an array
+    batch_products = []
 
     # Remove invalid/empty strings
     for i in range(0, len(collString)):
@@ -198,9 +332,26 @@ def ReadNavcamString(inString, inFillBool, inRadBool):
         curve_minval = 0.0
         curve_maxval = 1.0
 
-        if inRadBool:
-            image_16bit_texture_filename = get_16bit_texture_image(rover, sol_ref, theString, roverImageDir)
-            image_texture_filename = convert_to_png(image_16bit_texture_filename)
+        # preview: coarse mesh with the browse texture now, the rest from a timer
+        preview = inPreview and not (inMosaic or inJoin != 'NONE' or inDem != 'NONE')
+        if preview:
+            upgrade = {'product_id': theString, 'rover': rover, 'sol': sol_ref,
+                       'dirs': (roverDataDir, roverImageDir, local_data_dir),
+                       'fill': inFillBool, 'rad': inRadBool, 'rad_stretch': inRadStretch, 'rad_png': inRadPng,
+                       'geometry': geometry, 'lod_levels': inLodLevels, 'lod_distance': inLodDistance,
+                       'intensity': inPointIntensity, 'object': None, 'camera': None}
+            if time.time() - time_start > inPreviewBudget:
+                print('Preview time budget spent, import of %s deferred' %(theString))
+                queue_upgrade(upgrade)
+                continue
+
+        texture_image = None
+        if inRadBool and not preview:
+            image_texture_filename = get_16bit_texture_image(rover, sol_ref, theString)
+            if image_texture_filename != None:
+                texture_image = create_rad_texture_image(image_texture_filename, inRadStretch, inRadPng)
+                if texture_image == None:
+                    image_texture_filename = None
         else:
             image_texture_filename = get_texture_image(rover, sol_ref, theString)
 
@@ -214,8 +365,23 @@ def ReadNavcamString(inString, inFillBool, inRadBool):
             print (' >>>>>>> ERROR <<<<<<<<< XYZ file not found for id:', theString)
             print (' ')
             #example: 2N295460956EFFB1DNP1983L0M1 (not in sol 1904 but 1905)
+        elif preview:
+          preview_geometry = dict(geometry, resolution=max(geometry['resolution'], inPreviewResolution),
+                                  downsample='STRIDE', tolerance=0.0)
+          ob, cam_ob = create_mesh_from_depthimage(rover, sol_ref, image_depth_filename, image_texture_filename, inFillBool, False, None,
+                                                   preview_geometry, 0, inLodDistance, inPointIntensity, preview=True)
+          if ob != None:
+              upgrade['object'] = ob.name
+              upgrade['camera'] = cam_ob.name if cam_ob != None else None
+              redraw_now()
+          queue_upgrade(upgrade)
+        elif inMosaic or inJoin != 'NONE' or inDem != 'NONE':
+          batch_products.append({'product_id': theString, 'rover': rover, 'sol': sol_ref,
+                                  'depth': image_depth_filename, 'texture': image_texture_filename,
+                                  'texture_image': texture_image, 'curve': (curve_minval, curve_maxval)})
         else:
-          create_mesh_from_depthimage(rover, sol_ref, image_depth_filename, image_texture_filename, inFillBool, inRadBool)
+          create_mesh_from_depthimage(rover, sol_ref, image_depth_filename, image_texture_filename, inFillBool, inRadBool, texture_image, geometry,
+                                      inLodLevels, inLodDistance, inPointIntensity)
 
         # For color images we need 3 images, one per band. Example for MER:
         # 1p579517559mrdd2fap2377l2m1 - Band 2 at 753nm (=R)
@@ -224,7 +390,18 @@ def ReadNavcamString(inString, inFillBool, inRadBool):
         # SCLK: different
         # sequence number: same (p2377)
 
+    if len(batch_products):
+        if inDem != 'NONE':
+            create_site_dems(batch_products, inFillBool, geometry, inDem, inDemCell, inDemRule)
+        elif inMosaic:
+            # overlaps can only be compared within the frame of a site
+            create_joined_objects(batch_products, inFillBool, geometry, 'SITE', inMosaicVoxel, inPointIntensity)
+        else:
+            create_joined_objects(batch_products, inFillBool, geometry, inJoin, 0.0, inPointIntensity)
 
+    # previews still download from a timer, the connections are closed once it is done
+    if len(pending_upgrades) == 0:
+        close_http_connections()
 
     elapsed = float(time.time() - time_start)
     print("Script execution time: %s" % time.strftime('%H:%M:%S', time.gmtime(elapsed)))
@@ -235,48 +412,186 @@ def SetRenderSettings():
     rnd.resolution_x = 1024
     rnd.resolution_y = 1024
     rnd.resolution_percentage = 100
-    rnd.tile_x = 512
-    rnd.tile_y = 512
+    # render tiles are gone since Blender 3.0
+    if hasattr(rnd, 'tile_x'):
+        rnd.tile_x = 512
+        rnd.tile_y = 512
     wrld = bpy.context.scene.world
     nt = bpy.data.worlds[wrld.name].node_tree
     backNode = nt.nodes['Background']
     backNode.inputs[0].default_value = (0.02, 0.02, 0.02, 1)
 
 
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+DOWNLOAD_ATTEMPTS = 3
+
+
 def download_file(url):
+    # Fetch url into localfile. The response is streamed to localfile + '.part', which is
+    # renamed into place only once complete, so an interrupted transfer never leaves a
+    # truncated file that looks cached. Interrupted transfers are retried, resuming from
+    # the partial file where the server accepts an HTTP Range request.
     global localfile
     proper_url = url.replace('\\','/')
     print('**DOWNLOAD:', proper_url)
 
-    if sys.platform == 'darwin':
-        try:
-            out = subprocess.check_output(['curl', '-I', proper_url])
-            print('**DOWNLOAD OUT:')
-            print(out)
+    partfile = localfile + '.part'
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        result = download_part(proper_url, partfile)
+        if result == True:
+            os.replace(partfile, localfile)
+            return True
+        if result == False:
+            break
+        print('Download interrupted, retrying...')
+
+    # a partial file left after retries is resumed next time
+    if result == False and os.path.exists(partfile):
+        os.remove(partfile)
+    return False
 
-            if out.decode().find('200 OK') > 0:
-                subprocess.call(['curl', '-o', localfile, '-L', proper_url])
-                return True
-            else:
-                print('Fail to reach a server.\n\n{}'.format(out.decode()))
-                return False
 
-        except subprocess.CalledProcessError as e:
-            print('Subprocess failed:\nReturncode: {}\n\nOutput:{}'.format(e.returncode, e.output))
-            return False
+def download_part(url, partfile):
+    # One request for url, appended to what partfile already holds.
+    # Returns True when complete, False when the file is not available, None when interrupted.
+    offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' %(offset)
 
+    try:
+        response, connection = http_get(url, headers)
+    except (OSError, http.client.HTTPException) as e:
+        print('Fail to reach a server: %s' %(e))
+        return None
+
+    status = response.status
+    if status == 206:
+        # Content-Range: bytes <first>-<last>/<total>
+        match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', response.getheader('Content-Range', ''))
+        if match is None or int(match.group(1)) != offset:
+            connection.close()  # body left unread
+            os.remove(partfile)
+            return None
+        expected = int(match.group(2)) if match.group(2) != '*' else None
+        mode = 'ab'
+    elif status == 200:
+        length = response.getheader('Content-Length')
+        expected = int(length) if length is not None else None
+        mode = 'wb'
     else:
+        # read the (short) error page so that the connection can be used again
         try:
-            page = request.urlopen(proper_url)
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+        if status == 416 and offset > 0:
+            os.remove(partfile)  # stale partial file, start over
+            return None
+        print('Fail to reach a server: %s %s' %(status, response.reason))
+        return False
 
-            if page.getcode() is not 200:
-                return False
+    try:
+        with open(partfile, mode) as f:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                f.write(chunk)
+    except (OSError, http.client.HTTPException) as e:
+        connection.close()
+        print('Transfer failed: %s' %(e))
+        return None
 
-            request.urlretrieve(proper_url, localfile)
-            return True
+    size = os.path.getsize(partfile)
+    if expected is not None and size != expected:
+        connection.close()
+        print('Transfer incomplete: %d of %d bytes' %(size, expected))
+        return None
+    return True
 
-        except:
-            return False
+
+# Persistent HTTP connections, one per scheme and host, reused by every download of a
+# batch so that only the first request to a host pays for the DNS, TCP and TLS setup
+http_connections = {}
+HTTP_MAX_REDIRECTS = 5
+
+
+def http_connection(scheme, host):
+    # Pooled connection to host, through the proxy of the environment (http_proxy,
+    # https_proxy, no_proxy) as urlopen() would. Returns (connection, proxy_headers);
+    # proxy_headers is None unless the requests go through a plain HTTP proxy, which
+    # takes the absolute URL and these extra headers.
+    if (scheme, host) not in http_connections:
+        proxy = request.getproxies().get(scheme)
+        if proxy and request.proxy_bypass(host):
+            proxy = None
+
+        proxy_headers = None
+        if proxy is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(host, timeout=60)
+            else:
+                connection = http.client.HTTPConnection(host, timeout=60)
+        else:
+            parts = parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            proxy_host = parts.netloc.rpartition('@')[2]
+            auth = {}
+            if parts.username is not None:
+                credentials = '%s:%s' %(parse.unquote(parts.username), parse.unquote(parts.password or ''))
+                auth['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+            # HTTPS goes through a CONNECT tunnel, plain HTTP requests are relayed
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(proxy_host, timeout=60)
+                connection.set_tunnel(host, headers=auth)
+            else:
+                connection = http.client.HTTPConnection(proxy_host, timeout=60)
+                proxy_headers = auth
+            print('Connecting to %s through proxy %s' %(host, proxy_host))
+        http_connections[(scheme, host)] = (connection, proxy_headers)
+    return http_connections[(scheme, host)]
+
+
+def close_http_connections():
+    for connection, proxy_headers in http_connections.values():
+        connection.close()
+    http_connections.clear()
+
+
+def http_get(url, headers):
+    # GET url on the pooled connection of its host, following redirects.
+    # Returns (response, connection); the response must be read to the end, or the
+    # connection closed, before the next request to that host.
+    for redirect in range(HTTP_MAX_REDIRECTS + 1):
+        parts = parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, proxy_headers = http_connection(parts.scheme, parts.netloc)
+        request_headers = headers
+        if proxy_headers is not None:
+            path = '%s://%s%s' %(parts.scheme, parts.netloc, path)
+            request_headers = dict(headers, **proxy_headers)
+        try:
+            connection.request('GET', path, headers=request_headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            # the server may have closed the idle connection: once more on a new one
+            connection.close()
+            connection.request('GET', path, headers=request_headers)
+            response = connection.getresponse()
+
+        location = response.getheader('Location')
+        if response.status not in (301, 302, 303, 307, 308) or location is None:
+            return response, connection
+
+        response.read()
+        url = parse.urljoin(url, location)
+        print('**REDIRECT:', url)
+
+    raise http.client.HTTPException('Too many redirects: %s' %(url))
 
 
 def tosol(rover, nameID):
@@ -349,6 +664,131 @@ def tosol(rover, nameID):
     return sol+deviate
 
 
+# -----------------------------------------------------------------------------
+# Product catalog: a SQLite database in the cache folder holding the metadata of every
+# product fetched or parsed so far, so batch runs can look it up without opening IMG files.
+
+CATALOG_COLUMNS = ('product_id', 'rover', 'sol', 'site', 'drive', 'camera', 'product_type',
+                   'lines', 'line_samples', 'bands', 'origin_x', 'origin_y', 'origin_z',
+                   'start_time', 'path', 'size', 'mtime')
+
+
+def get_catalog():
+    # Connection to the catalog of the current cache folder, None before a cache folder is set
+    global catalog_db, catalog_path
+
+    if not local_data_dir:
+        return None
+
+    path = os.path.join(local_data_dir, 'catalog.sqlite')
+    if catalog_db is not None and catalog_path == path:
+        return catalog_db
+
+    if catalog_db is not None:
+        catalog_db.close()
+
+    if not os.path.exists(local_data_dir):
+        os.makedirs(local_data_dir)
+
+    catalog_db = sqlite3.connect(path)
+    catalog_db.row_factory = sqlite3.Row
+    catalog_db.execute('CREATE TABLE IF NOT EXISTS products ('
+                       'product_id TEXT PRIMARY KEY, rover INTEGER, sol INTEGER, site TEXT, drive TEXT, '
+                       'camera TEXT, product_type TEXT, lines INTEGER, line_samples INTEGER, bands INTEGER, '
+                       'origin_x REAL, origin_y REAL, origin_z REAL, start_time TEXT, '
+                       'path TEXT, size INTEGER, mtime REAL)')
+    catalog_db.execute('CREATE INDEX IF NOT EXISTS products_sol ON products (rover, sol, site, drive)')
+    catalog_path = path
+    return catalog_db
+
+
+def parse_product_id(product_id):
+    # Fields encoded in a product name, see tosol() for the MER naming convention.
+    # MSL: NLB_499684210EDR_F0501222NCAM00290M_
+    #      0: N = Navcam, 1: L = left, 4-12: sclk, 13-15: product type, 18-20: site, 21-24: drive
+    product_id = product_id.upper()
+    cameras = {'N': 'navcam', 'P': 'pancam', 'F': 'fhazcam', 'R': 'rhazcam'}
+
+    if len(product_id) == MSL_LENGTH and product_id.startswith('N'):
+        rover = CURIOSITY
+        return {'rover': rover, 'sol': tosol(rover, product_id), 'camera': 'navcam',
+                'product_type': product_id[13:16], 'site': product_id[18:21], 'drive': product_id[21:25]}
+
+    if len(product_id) == MER_LENGTH and product_id[0] in '12':
+        rover = OPPORTUNITY if product_id[0] == '1' else SPIRIT
+        return {'rover': rover, 'sol': tosol(rover, product_id), 'camera': cameras.get(product_id[1]),
+                'product_type': product_id[11:14], 'site': product_id[14:16], 'drive': product_id[16:18]}
+
+    return None
+
+
+def catalog_product_id(filename):
+    # '2N1...M1.IMG', '2n1...m1.img.JPG' -> '2N1...M1'
+    return os.path.basename(filename).split('.')[0].upper()
+
+
+def catalog_update(product_id, values):
+    db = get_catalog()
+    if db is None:
+        return
+    db.execute('INSERT OR IGNORE INTO products (product_id) VALUES (?)', (product_id,))
+    names = sorted(values)
+    db.execute('UPDATE products SET %s WHERE product_id = ?' %(', '.join('%s = ?' %(n) for n in names)),
+               [values[n] for n in names] + [product_id])
+    db.commit()
+
+
+def catalog_record_file(filename):
+    # Record a product file present in the cache. Returns filename, so it can wrap a return value.
+    if filename == None:
+        return filename
+
+    try:
+        st = os.stat(filename)
+        product_id = catalog_product_id(filename)
+        values = parse_product_id(product_id) or {}
+        values.update({'path': filename, 'size': st.st_size, 'mtime': st.st_mtime})
+        catalog_update(product_id, values)
+    except (OSError, sqlite3.Error) as e:
+        print('Unable to record %s in catalog: %s' %(filename, e))
+
+    return filename
+
+
+def catalog_record_label(label):
+    values = {'lines': label.LINES, 'line_samples': label.LINE_SAMPLES, 'bands': label.BANDS,
+              'start_time': label.START_TIME}
+    if label.ORIGIN_OFFSET_VECTOR is not None:
+        values['origin_x'], values['origin_y'], values['origin_z'] = label.ORIGIN_OFFSET_VECTOR
+
+    try:
+        catalog_update(catalog_product_id(label.filename), values)
+    except sqlite3.Error as e:
+        print('Unable to record %s in catalog: %s' %(label.filename, e))
+    catalog_record_file(label.filename)
+
+
+def catalog_lookup(product_id):
+    # Catalog row of a product as a dict, or None if it was never seen
+    db = get_catalog()
+    if db is None:
+        return None
+    row = db.execute('SELECT * FROM products WHERE product_id = ?', (catalog_product_id(product_id),)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def catalog_query(**fields):
+    # e.g. catalog_query(rover=SPIRIT, sol=1869, product_type='XYL')
+    db = get_catalog()
+    if db is None:
+        return []
+    names = sorted(n for n in fields if n in CATALOG_COLUMNS)
+    where = ' AND '.join('%s = ?' %(n) for n in names) or '1'
+    rows = db.execute('SELECT * FROM products WHERE %s ORDER BY rover, sol, product_id' %(where),
+                                 [fields[n] for n in names])
+    return [dict(row) for row in rows]
+
+
 def get_texture_image(rover, sol, imgname):
     global roverImageDir, local_data_dir, localfile
 
@@ -403,7 +843,7 @@ def get_texture_image(rover, sol, imgname):
 
     if os.path.isfile(imgfilename):
         print('   EFF texture found, loading...')
-        return imgfilename
+        return catalog_record_file(imgfilename)
     else :
       s[11] = 'f'
       s[12] = 'f'
@@ -415,7 +855,7 @@ def get_texture_image(rover, sol, imgname):
       print('#### EFF texture not found; looking for alternative (FFL) texture in cache: ', imgfilename2)
       if os.path.isfile(imgfilename2):
           print('   ----> FFL texture found, loading...')
-          return imgfilename2
+          return catalog_record_file(imgfilename2)
       else :
         s[11] = 'm'
         s[12] = 'r'
@@ -427,7 +867,7 @@ def get_texture_image(rover, sol, imgname):
         print('#### MRL texture not found; looking for alternative (MRL) texture in cache: ', imgfilename3)
         if os.path.isfile(imgfilename3):
             print('   ----> MRL texture found.')
-            return imgfilename3
+            return catalog_record_file(imgfilename3)
         else :
             print ('##!## I give up, no texture available in cache, loking online....')
 
@@ -492,15 +932,15 @@ def get_texture_image(rover, sol, imgname):
         else :
           print('  ---> MRL texture successfully downloaded.')
           imgfilename = os.path.join(local_data_dir, roverImageDir, 'sol%04d' %(sol), 'rdr', imagename3 )
-          return imgfilename # MRL
+          return catalog_record_file(imgfilename) # MRL
       else :
         print('  ---> FFL texture successfully downloaded.')
         imgfilename = os.path.join(local_data_dir, roverImageDir, 'sol%04d' %(sol), 'rdr', imagename2 )
-        return imagename #FFL texture
+        return catalog_record_file(imgfilename) #FFL texture
     else :
       print('  ---> EFF texture successfully downloaded.')
       imgfilename = os.path.join(local_data_dir, roverImageDir, 'sol%04d' %(sol), 'rdr', imagename )
-      return imgfilename #EFF texture
+      return catalog_record_file(imgfilename) #EFF texture
 
 
 #    if os.path.isfile(localfile):
@@ -530,7 +970,7 @@ def get_16bit_texture_image(rover, sol, imgname):
 
     if os.path.isfile(imgfilename):
         print('Loading 16 bit texture (rad) from cache: ', imgfilename)
-        return imgfilename
+        return catalog_record_file(imgfilename)
 
     retrievedir = os.path.join(os.path.dirname(local_data_dir), roverImageDir, 'sol%04d' %( sol ) , 'rdr')
     print ('16 bit texture files (rad) are cached into ', retrievedir)
@@ -551,7 +991,7 @@ def get_16bit_texture_image(rover, sol, imgname):
         return None
 
     if os.path.isfile(localfile):
-        return imgfilename
+        return catalog_record_file(imgfilename)
 
 
 def get_depth_image(rover, sol, imgname):
@@ -577,9 +1017,14 @@ def get_depth_image(rover, sol, imgname):
     print ('XYZ data file:', xyzfilename)
     print ('Searching in cache....')
 
+    decodedfilename = find_decoded_product(xyzfilename)
+    if decodedfilename != None:
+        print('  ---> OK, decoded XYZ found in cache')
+        return decodedfilename
+
     if os.path.isfile(xyzfilename):
         print('  ---> OK, XYZ found in cache')
-        return xyzfilename
+        return catalog_record_file(xyzfilename)
 
     print ('#### XYZ not found in cache, looking online...')
     retrievedir = os.path.join(local_data_dir, roverDataDir, 'sol%04d' %(sol) , 'rdr')
@@ -607,138 +1052,76 @@ def get_depth_image(rover, sol, imgname):
 
     if os.path.isfile(localfile):
         print('Local file:',localfile)
-        return xyzfilename
+        return catalog_record_file(xyzfilename)
     else :
         print('>>> ERROR >>>> Can\'t find local file just downloaded!:', localfile)
         return None
 
 
-def convert_to_png(image_16bit_texture_filename):
+def create_rad_texture_image(image_16bit_texture_filename, stretch_percent=0.0, save_png=False):
+    # Build a float Blender image straight from a RAD (or RFD) product. The RGBA buffer is
+    # filled with a single foreach_set; the PNG is only written when save_png is set.
+    # curve_minval/curve_maxval are set to the value range, or to the given lower and
+    # upper percentiles when stretch_percent > 0.
     global curve_minval, curve_maxval
 
-    LINES = LINE_SAMPLES = SAMPLE_BITS = BYTES = 0
-    SAMPLE_TYPE = ""
-
     FileAndPath = image_16bit_texture_filename
     FileAndExt = os.path.splitext(FileAndPath)
 
-    print('creating png...')
-
-    # Open the img file (ascii label part)
-    try:
-        if FileAndExt[1].isupper():
-            f = open(FileAndExt[0] + ".IMG", 'r')
-        else:
-            f = open(FileAndExt[0] + ".img", 'r')
-    except:
-        return
-
-    block = ""
-    OFFSET = 0
-    for line in f:
-        if line.strip() == "END":
-            break
-        tmp = line.split("=")
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE":
-            block = "IMAGE"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE":
-            block = ""
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = "IMAGE_HEADER"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = ""
-
-        if block == "IMAGE":
-            if line.find("LINES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINES = int(tmp[1].strip())
-            elif line.find("LINE_SAMPLES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINE_SAMPLES = int(tmp[1].strip())
-            elif line.find("SAMPLE_TYPE") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_TYPE = tmp[1].strip()
-            elif line.find("SAMPLE_BITS") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_BITS = int(tmp[1].strip())
-
-        if block == "IMAGE_HEADER":
-            if line.find("BYTES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                BYTES = int(tmp[1].strip())
-
-    f.close
-
-    # Open the img file (binary data part)
-    try:
-        if FileAndExt[1].isupper():
-            f2 = open(FileAndExt[0] + ".IMG", 'rb')
-        else:
-            f2 = open(FileAndExt[0] + ".img", 'rb')
-    except:
-        return
-
-    edit = f2.read()
-    meh = edit.find(b'LBLSIZE')
-    f2.seek( meh + BYTES)
-
-    bands = []
-    for bandnum in range(0, 1):
-
-        bands.append([])
-        for linenum in range(0, LINES):
-
-            bands[bandnum].append([])
-            for pixnum in range(0, LINE_SAMPLES):
-
-                dataitem = f2.read(2)
-                if (dataitem == ""):
-                    print ('ERROR, Ran out of data to read before we should have')
+    print('creating texture from 16 bit RAD...')
 
-                bands[bandnum][linenum].append(struct.unpack(">H", dataitem)[0])
-
-    f2.close
+    label = read_pds_label(FileAndPath)
+    if label is None:
+        return None
 
-    pixels = [None] * LINES * LINE_SAMPLES
+    mm = map_img_file(FileAndPath)
+    if mm is None:
+        return None
 
-    curve_minval = 1.0
-    curve_maxval = 0.0
+    band = decode_image(label, mm)
+    if band is None:
+        return None
 
-    for j in range(0, LINES):
-        for k in range(0, LINE_SAMPLES):
+    # Integer samples are scaled to 0..1, e.g. 16 bit RAD; float RFD samples are used as-is.
+    # Blender stores the bottom row first, hence the flip.
+    scale = float(2 ** label.SAMPLE_BITS) if band.dtype.kind in 'iu' else 1.0
+    band = np.flipud(band[0]).astype(np.float32) / scale
 
-            r = g = b = float(bands[0][LINES-1 - j][k] & 0xffff )  / (32768*2)
-            a = 1.0
-            pixels[(j * LINES) + k] = [r, g, b, a]
+    if stretch_percent > 0.0:
+        curve_minval, curve_maxval = (float(v) for v in np.percentile(band, (stretch_percent, 100.0 - stretch_percent)))
+    else:
+        curve_minval, curve_maxval = float(band.min()), float(band.max())
 
-            if r > curve_maxval: curve_maxval = r
-            if r < curve_minval: curve_minval = r
+    pixels = np.empty((label.LINES, label.LINE_SAMPLES, 4), dtype=np.float32)
+    pixels[:, :, :3] = band[:, :, np.newaxis]
+    pixels[:, :, 3] = 1.0
+    del band
 
-    del bands
+    image = bpy.data.images.new(os.path.basename(FileAndExt[0]), label.LINE_SAMPLES, label.LINES, float_buffer=True)
+    image.pixels.foreach_set(pixels.ravel())
+    del pixels
 
-    pixels = [chan for px in pixels for chan in px]
-    pngname = FileAndExt[0] + '.PNG'
+    if save_png:
+        pngname = FileAndExt[0] + '.PNG'
 
-    # modify scene for png export
-    scene = bpy.data.scenes[0]
-    settings = scene.render.image_settings
-    settings.color_depth = '16'
-    settings.color_mode = 'BW'
-    settings.file_format = 'PNG'
+        # modify scene for png export
+        scene = bpy.data.scenes[0]
+        settings = scene.render.image_settings
+        settings.color_depth = '16'
+        settings.color_mode = 'BW'
+        settings.file_format = 'PNG'
 
-    image = bpy.data.images.new(os.path.basename(FileAndExt[0]), LINES, LINE_SAMPLES, float_buffer=True)
-    image.pixels = pixels
-    image.file_format = 'PNG'
-    image.save_render(pngname)
+        image.file_format = 'PNG'
+        image.save_render(pngname)
+        image.filepath_raw = pngname
 
-    settings.color_depth = '8'
-    settings.color_mode = 'RGBA'
+        settings.color_depth = '8'
+        settings.color_mode = 'RGBA'
+        print('RAD texture saved as ', pngname)
 
-    # remove converted image from Blender, it will be reloaded
-    bpy.data.images.remove(image)
-    del pixels
+    image.pack()
 
-    return pngname
+    return image
 
 
 # -----------------------------------------------------------------------------
@@ -893,7 +1276,7 @@ def create_cycles_texnode(context, node_tree, image):
 def create_cycles_material(context, image):
     global curve_minval, curve_maxval
 
-    name_compat = bpy.path.display_name_from_filepath(image.filepath)
+    name_compat = bpy.path.display_name_from_filepath(image.filepath) if image.filepath else image.name
     material = None
     if not material:
         material = bpy.data.materials.new(name=name_compat)
@@ -962,181 +1345,1373 @@ def get_collection(name):
         return bpy.data.collections.get(name)
 
 
-def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_filename, do_fill, do_rad):
-    # snippets used from:
-    # https://svn.blender.org/svnroot/bf-extensions/contrib/py/scripts/addons/io_import_LRO_Lola_MGS_Mola_img.py
-    # https://arsf-dan.nerc.ac.uk/trac/attachment/wiki/Processing/SyntheticDataset/data_handler.py
+class PdsLabel:
+    # Values of a PDS label needed to locate and decode the image data of an IMG product.
+    # Attribute names follow the PDS keywords they are read from.
 
-    global curve_minval, curve_maxval
+    def __init__(self, filename):
+        self.filename = filename
+        self.RECORD_BYTES = 0
+        self.LABEL_RECORDS = 0
+        self.START_TIME = None
+        self.LINES = 0
+        self.LINE_SAMPLES = 0
+        self.BANDS = 1
+        self.SAMPLE_TYPE = ''
+        self.SAMPLE_BITS = 0
+        self.BAND_STORAGE_TYPE = 'BAND_SEQUENTIAL'
+        self.LINE_PREFIX_BYTES = 0
+        self.LINE_SUFFIX_BYTES = 0
+        self.IMAGE_HEADER_BYTES = 0
+        self.ORIGIN_OFFSET_VECTOR = None  # (x, y, z) in rover frame, metres
+        self.LBLSIZE = 0
+        self.image_header_offset = None  # byte offset of the VICAR label
+        self.image_offset = None  # byte offset of the image data
 
-    bRoverVec = Vector((0.0, 0.0, 0.0))
 
-    if image_depth_filename == '':
-        return
+label_cache = {}
 
-    creation_date = None
-    LINES = LINE_SAMPLES = SAMPLE_BITS = 0
-    SAMPLE_TYPE = ""
 
-    FileAndPath = image_depth_filename
-    FileAndExt = os.path.splitext(FileAndPath)
+def pds_int(value):
+    # Integer label values may carry a unit, e.g. "BYTES = 2048 <BYTES>"
+    return int(value.split('<')[0].strip())
 
-    print('Creating mesh...')
 
-    # Open the img label file (ascii label part)
+def parse_pds_pointer(value, record_bytes):
+    # ^IMAGE = 11 / 11 <BYTES> / ("FILE.IMG", 11) / ("FILE.IMG", 40961 <BYTES>)
+    # Returns a 0-based byte offset, or None if the value can't be interpreted.
+    value = value.strip('()').split(',')[-1].strip()
+    in_bytes = value.upper().endswith('<BYTES>')
+    try:
+        position = int(value.split('<')[0].strip())
+    except ValueError:
+        return None
+    if in_bytes:
+        return position - 1
+    return (position - 1) * record_bytes
+
+
+def read_pds_label(filename):
+    # Parse the ASCII PDS label of an IMG product, reading only the label bytes.
+    # Results are memoized per file path and modification time.
+    try:
+        st = os.stat(filename)
+    except OSError:
+        print('Unable to open %s' %(filename))
+        return None
+
+    key = os.path.abspath(filename)
+    cached = label_cache.get(key)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+
+    label = PdsLabel(filename)
+    pointers = {}
+    blocks = []
+
+    with open(filename, 'rb') as f:
+        pending = ''
+        for raw in f:
+            line = raw.decode('ascii', 'replace').strip()
+            if line == 'END':
+                break
+            if line.startswith('/*') or line == '':
+                continue
+
+            # values like (x, y, z) may be continued on the next lines
+            line = pending + line
+            if line.count('(') > line.count(')'):
+                pending = line + ' '
+                continue
+            pending = ''
+
+            keyword, sep, value = line.partition('=')
+            if not sep:
+                continue
+            keyword = keyword.strip()
+            value = value.split('/*')[0].strip()
+
+            if keyword in ('OBJECT', 'GROUP'):
+                blocks.append(value)
+                continue
+            if keyword in ('END_OBJECT', 'END_GROUP'):
+                if blocks:
+                    blocks.pop()
+                continue
+
+            block = blocks[-1] if blocks else ''
+
+            if keyword.startswith('^'):
+                pointers[keyword[1:]] = value
+            elif block == '':
+                if keyword == 'RECORD_BYTES':
+                    label.RECORD_BYTES = pds_int(value)
+                elif keyword == 'LABEL_RECORDS':
+                    label.LABEL_RECORDS = pds_int(value)
+                elif keyword == 'START_TIME':
+                    label.START_TIME = value.strip('"')
+            elif block == 'IMAGE':
+                if keyword == 'LINES':
+                    label.LINES = pds_int(value)
+                elif keyword == 'LINE_SAMPLES':
+                    label.LINE_SAMPLES = pds_int(value)
+                elif keyword == 'BANDS':
+                    label.BANDS = pds_int(value)
+                elif keyword == 'SAMPLE_TYPE':
+                    label.SAMPLE_TYPE = value.strip('"')
+                elif keyword == 'SAMPLE_BITS':
+                    label.SAMPLE_BITS = pds_int(value)
+                elif keyword == 'BAND_STORAGE_TYPE':
+                    label.BAND_STORAGE_TYPE = value.strip('"')
+                elif keyword == 'LINE_PREFIX_BYTES':
+                    label.LINE_PREFIX_BYTES = pds_int(value)
+                elif keyword == 'LINE_SUFFIX_BYTES':
+                    label.LINE_SUFFIX_BYTES = pds_int(value)
+            elif block == 'IMAGE_HEADER':
+                if keyword == 'BYTES':
+                    label.IMAGE_HEADER_BYTES = pds_int(value)
+            elif block == 'ROVER_COORDINATE_SYSTEM':
+                if keyword == 'ORIGIN_OFFSET_VECTOR':
+                    pf = re.sub('[()]', '', value).split(',')
+                    label.ORIGIN_OFFSET_VECTOR = (float(pf[0]), float(pf[1]), float(pf[2]))
+
+            if keyword == 'START_TIME' and label.START_TIME is None:
+                label.START_TIME = value.strip('"')
+
+        if 'IMAGE_HEADER' in pointers:
+            label.image_header_offset = parse_pds_pointer(pointers['IMAGE_HEADER'], label.RECORD_BYTES)
+        if 'IMAGE' in pointers:
+            label.image_offset = parse_pds_pointer(pointers['IMAGE'], label.RECORD_BYTES)
+
+        # The VICAR label starts with LBLSIZE=<n>, n being the size of the VICAR label
+        if label.image_header_offset is not None:
+            f.seek(label.image_header_offset)
+            head = f.read(32).decode('ascii', 'replace')
+            match = re.match(r'LBLSIZE\s*=\s*(\d+)', head)
+            if match:
+                label.LBLSIZE = int(match.group(1))
+
+    if label.image_offset is None and label.image_header_offset is not None:
+        label.image_offset = label.image_header_offset + (label.IMAGE_HEADER_BYTES or label.LBLSIZE)
+
+    if label.image_offset is None:
+        print('Unable to locate image data in %s' %(filename))
+        return None
+
+    label_cache[key] = ((st.st_mtime_ns, st.st_size), label)
+    catalog_record_label(label)
+    return label
+
+
+def map_img_file(filename):
+    # Memory-map an IMG product read-only, so only the pages actually touched get loaded.
+    # The mapping stays open for as long as an array view created from it is referenced.
+    try:
+        with open(filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        print('Unable to map %s' %(filename))
+        return None
+
+
+def img_data_view(mm, offset, dtype, count):
+    # Zero-copy view of 'count' samples of 'dtype' starting at byte 'offset' of the mapping.
+    # Returns fewer samples if the file is truncated.
+    dtype = np.dtype(dtype)
+    available = max(0, (len(mm) - offset) // dtype.itemsize)
+    return np.frombuffer(mm, dtype=dtype, count=min(count, available), offset=offset)
+
+
+# PDS SAMPLE_TYPE -> (byte order, numpy kind)
+PDS_SAMPLE_TYPES = {
+    'IEEE_REAL': ('>', 'f'),
+    'REAL': ('>', 'f'),
+    'FLOAT': ('>', 'f'),
+    'MAC_REAL': ('>', 'f'),
+    'SUN_REAL': ('>', 'f'),
+    'PC_REAL': ('<', 'f'),
+    'MSB_INTEGER': ('>', 'i'),
+    'INTEGER': ('>', 'i'),
+    'MAC_INTEGER': ('>', 'i'),
+    'SUN_INTEGER': ('>', 'i'),
+    'LSB_INTEGER': ('<', 'i'),
+    'PC_INTEGER': ('<', 'i'),
+    'VAX_INTEGER': ('<', 'i'),
+    'MSB_UNSIGNED_INTEGER': ('>', 'u'),
+    'UNSIGNED_INTEGER': ('>', 'u'),
+    'MAC_UNSIGNED_INTEGER': ('>', 'u'),
+    'SUN_UNSIGNED_INTEGER': ('>', 'u'),
+    'LSB_UNSIGNED_INTEGER': ('<', 'u'),
+    'PC_UNSIGNED_INTEGER': ('<', 'u'),
+    'VAX_UNSIGNED_INTEGER': ('<', 'u'),
+}
+
+
+def pds_sample_dtype(label):
+    # numpy dtype of one sample, from SAMPLE_TYPE and SAMPLE_BITS
+    order, kind = PDS_SAMPLE_TYPES.get(label.SAMPLE_TYPE.upper(), (None, None))
+    if kind is None:
+        print('Unsupported SAMPLE_TYPE %s' %(label.SAMPLE_TYPE))
+        return None
+    if label.SAMPLE_BITS == 8:
+        order = '|'
+    return np.dtype('%s%s%d' %(order, kind, label.SAMPLE_BITS // 8))
+
+
+def decode_image(label, mm, native=True):
+    # Decode all bands of an IMG product in one bulk read.
+    # Returns a (BANDS, LINES, LINE_SAMPLES) array in native byte order. When no byte swap
+    # is needed, or native is False, the result is a read-only view on the mapped file.
+    dtype = pds_sample_dtype(label)
+    if dtype is None:
+        return None
+
+    bands = label.BANDS
+    lines = label.LINES
+    samples = label.LINE_SAMPLES
+    storage = label.BAND_STORAGE_TYPE.upper()
+
+    # One record per line of one band (BSQ/BIL) or per line of all bands (BIP),
+    # each surrounded by its line prefix and suffix bytes.
+    if storage == 'SAMPLE_INTERLEAVED':
+        records = lines
+        per_record = samples * bands
+    else:
+        records = bands * lines
+        per_record = samples
+
+    prefix = label.LINE_PREFIX_BYTES
+    record_bytes = prefix + per_record * dtype.itemsize + label.LINE_SUFFIX_BYTES
+    record = np.dtype({'names': ['data'], 'formats': [(dtype, (per_record,))],
+                       'offsets': [prefix], 'itemsize': record_bytes})
+
+    data = img_data_view(mm, label.image_offset, record, records)
+    if data.size != records:
+        print ('ERROR, Ran out of data to read before we should have')
+        padded = np.zeros(records, dtype=record)
+        padded[:data.size] = data
+        data = padded
+    data = data['data']
+
+    if storage == 'SAMPLE_INTERLEAVED':
+        data = data.reshape(lines, samples, bands).transpose(2, 0, 1)
+    elif storage == 'LINE_INTERLEAVED':
+        data = data.reshape(lines, bands, samples).transpose(1, 0, 2)
+    else:
+        data = data.reshape(bands, lines, samples)
+
+    if native and not data.dtype.isnative:
+        data = data.astype(data.dtype.newbyteorder('='))
+
+    return data
+
+
+def read_xyz_bands(label, mm):
+    # Band 0 = X, Band 1 = Y, Band 2 = Z, in metres in the rover frame.
+    # Returned as a (3, lines, samples) float32 array of its own: a native byte order
+    # product decodes to a read-only view on the mapped file.
+    data = decode_image(label, mm)
+    if data is None or data.shape[0] != 3:
+        print('Not a XYZ product: %s' %(label.filename))
+        return None
+
+    return np.array(data, dtype=np.float32)
+
+
+# -----------------------------------------------------------------------------
+# Decoded XYZ cache: next to each XYZ IMG product the decoded bands are stored once as
+# little-endian .npy arrays (memory-mapped on load) plus a validity mask, or as a single
+# compressed .npz. Float16 storage is optional.
+
+DECODED_XYZ_SUFFIX = '.xyz'
+DECODED_HALF_SUFFIX = '.xyz16'
+DECODED_MASK_SUFFIX = '.valid'
+
+# every storage variant: (suffix, half precision, compressed)
+DECODED_VARIANTS = [(DECODED_XYZ_SUFFIX + '.npy', False, False), (DECODED_XYZ_SUFFIX + '.npz', False, True),
+                    (DECODED_HALF_SUFFIX + '.npy', True, False), (DECODED_HALF_SUFFIX + '.npz', True, True)]
+
+
+def decoded_product_filename(img_filename, compressed, half=False):
+    # the storage precision is part of the name, so that changing it makes the artifact stale
+    return img_filename + (DECODED_HALF_SUFFIX if half else DECODED_XYZ_SUFFIX) + ('.npz' if compressed else '.npy')
+
+
+def is_decoded_product(filename):
+    return any(filename.endswith(suffix) for suffix, half, compressed in DECODED_VARIANTS)
+
+
+def img_filename_of_decoded(filename):
+    for suffix, half, compressed in DECODED_VARIANTS:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def label_for_product(img_filename):
+    # Label metadata of a product, from the catalog when it matches the file on disk
+    # (or the file is gone), otherwise parsed from the IMG label.
+    row = catalog_lookup(img_filename)
+    try:
+        mtime = os.path.getmtime(img_filename)
+    except OSError:
+        mtime = None
+
+    if row is not None and row['lines'] and (mtime is None or row['mtime'] == mtime):
+        label = PdsLabel(img_filename)
+        label.LINES = row['lines']
+        label.LINE_SAMPLES = row['line_samples']
+        label.BANDS = row['bands']
+        label.START_TIME = row['start_time']
+        if row['origin_x'] is not None:
+            label.ORIGIN_OFFSET_VECTOR = (row['origin_x'], row['origin_y'], row['origin_z'])
+        return label
+
+    if mtime is None:
+        return None
+    return read_pds_label(img_filename)
+
+
+def find_decoded_product(img_filename):
+    # Decoded artifact of an XYZ product if it is at least as recent as the IMG file and
+    # stored as the current cache settings ask for; any other one is stale
     try:
-        if FileAndExt[1].isupper():
-            f = open(FileAndExt[0] + ".IMG", 'r')
+        img_mtime = os.path.getmtime(img_filename)
+    except OSError:
+        img_mtime = None
+        if catalog_lookup(img_filename) is None:
+            return None
+
+    filename = decoded_product_filename(img_filename, decoded_cache_compress, decoded_cache_half)
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return None
+    if img_mtime is None or mtime >= img_mtime:
+        return filename
+
+    return None
+
+
+def save_decoded_product(img_filename, xyz, valid):
+    filename = decoded_product_filename(img_filename, decoded_cache_compress, decoded_cache_half)
+    xyz = xyz.astype('<f2' if decoded_cache_half else '<f4')
+
+    try:
+        if decoded_cache_compress:
+            with open(filename + '.part', 'wb') as f:
+                np.savez_compressed(f, xyz=xyz, valid=valid)
         else:
-            f = open(FileAndExt[0] + ".img", 'r')
-    except:
-        return
+            # the mask goes first: a present xyz file implies a complete mask
+            maskname = img_filename + DECODED_MASK_SUFFIX + '.npy'
+            with open(maskname + '.part', 'wb') as f:
+                np.save(f, valid)
+            os.replace(maskname + '.part', maskname)
+            with open(filename + '.part', 'wb') as f:
+                np.save(f, xyz)
+        os.replace(filename + '.part', filename)
+        remove_stale_decoded_products(img_filename, filename)
+    except (IOError, OSError) as e:
+        print('Unable to cache decoded XYZ %s: %s' %(filename, e))
+
+
+def write_decoded_product(img_filename, xyz, block_lines=256):
+    # save_decoded_product() for the xyz view of an opened IMG, see open_depth_product(),
+    # block_lines at a time into mapped .npy files, so that the product is never whole in
+    # memory. Returns the artifact filename, None on failure.
+    filename = decoded_product_filename(img_filename, False, decoded_cache_half)
+    maskname = img_filename + DECODED_MASK_SUFFIX + '.npy'
+    lines = xyz.shape[1]
 
-    block = ""
-    OFFSET = 0
-    for line in f:
-        if line.strip() == "END":
+    try:
+        target = np.lib.format.open_memmap(filename + '.part', mode='w+', shape=xyz.shape,
+                                           dtype='<f2' if decoded_cache_half else '<f4')
+        mask = np.lib.format.open_memmap(maskname + '.part', mode='w+', shape=xyz.shape[1:], dtype=bool)
+        for start in range(0, lines, block_lines):
+            block, block_valid = read_xyz_block(xyz, None, start, start + block_lines)
+            target[:, start:start + block_lines] = block
+            mask[start:start + block_lines] = block_valid
+        target.flush()
+        mask.flush()
+        del target, mask
+
+        # the mask goes first: a present xyz file implies a complete mask
+        os.replace(maskname + '.part', maskname)
+        os.replace(filename + '.part', filename)
+        remove_stale_decoded_products(img_filename, filename)
+    except (IOError, OSError) as e:
+        print('Unable to cache decoded XYZ %s: %s' %(filename, e))
+        return None
+    return filename
+
+
+def remove_stale_decoded_products(img_filename, filename):
+    # artifacts stored with other settings than the new one, filename, are stale now;
+    # a compressed one holds its mask, the separate one of the .npy variants goes too
+    stale = [img_filename + suffix for suffix, half, compressed in DECODED_VARIANTS]
+    if filename.endswith('.npz'):
+        stale.append(img_filename + DECODED_MASK_SUFFIX + '.npy')
+    for stale_filename in stale:
+        if stale_filename != filename and os.path.exists(stale_filename):
+            os.remove(stale_filename)
+
+
+def load_depth_product(filename):
+    # Returns (label, xyz, valid) for an XYZ IMG product or its decoded artifact.
+    # xyz is a (3, lines, samples) float32 array with invalid samples set to 0, valid a
+    # (lines, samples) bool array. Decoding an IMG also refreshes its decoded artifact.
+    if is_decoded_product(filename):
+        img_filename = img_filename_of_decoded(filename)
+        label = label_for_product(img_filename)
+        if label is None:
+            return None, None, None
+
+        try:
+            if filename.endswith('.npz'):
+                with np.load(filename) as data:
+                    xyz = data['xyz']
+                    valid = data['valid']
+            else:
+                xyz = np.load(filename, mmap_mode='r')
+                valid = np.load(img_filename + DECODED_MASK_SUFFIX + '.npy', mmap_mode='r')
+        except (IOError, OSError, ValueError) as e:
+            print('Unable to read decoded XYZ %s: %s' %(filename, e))
+            return None, None, None
+
+        print('Decoded XYZ loaded from cache: ', filename)
+        xyz = np.array(xyz, dtype=np.float32)
+        valid = np.array(valid, dtype=bool)
+        xyz[:, ~valid] = 0.0
+        return label, xyz, valid
+
+    label = read_pds_label(filename)
+    if label is None:
+        return None, None, None
+
+    mm = map_img_file(filename)
+    if mm is None:
+        return None, None, None
+
+    xyz = read_xyz_bands(label, mm)
+    if xyz is None:
+        return None, None, None
+
+    # samples lacking xyz data are (0, 0, 0)
+    valid = np.isfinite(xyz).all(axis=0) & (xyz != 0.0).any(axis=0)
+    xyz[:, ~valid] = 0.0
+
+    save_decoded_product(filename, xyz, valid)
+    return label, xyz, valid
+
+
+def open_depth_product(filename):
+    # Like load_depth_product() but nothing is read yet: returns (label, xyz, valid) with xyz
+    # a (3, lines, samples) view on the mapped decoded cache or IMG file (maybe float16 or
+    # byte swapped) and valid the mapped cached mask or None, see read_xyz_block().
+    # An IMG without a current decoded artifact gets one written block by block, see
+    # write_decoded_product(), and that is opened instead; a compressed one cannot be
+    # written that way, the IMG is then read as is.
+    if is_decoded_product(filename):
+        if filename.endswith('.npz'):
+            return load_depth_product(filename)  # compressed, cannot be mapped
+
+        img_filename = img_filename_of_decoded(filename)
+        label = label_for_product(img_filename)
+        if label is None:
+            return None, None, None
+        try:
+            xyz = np.load(filename, mmap_mode='r')
+            valid = np.load(img_filename + DECODED_MASK_SUFFIX + '.npy', mmap_mode='r')
+        except (IOError, OSError, ValueError) as e:
+            print('Unable to read decoded XYZ %s: %s' %(filename, e))
+            return None, None, None
+        return label, xyz, valid
+
+    decoded = find_decoded_product(filename)
+    if decoded is not None:
+        return open_depth_product(decoded)
+
+    label = read_pds_label(filename)
+    if label is None:
+        return None, None, None
+
+    mm = map_img_file(filename)
+    if mm is None:
+        return None, None, None
+
+    xyz = decode_image(label, mm, native=False)
+    if xyz is None or xyz.shape[0] != 3:
+        print('Not a XYZ product: %s' %(label.filename))
+        return None, None, None
+
+    if not decoded_cache_compress:
+        decoded = write_decoded_product(filename, xyz, decode_block_lines or 256)
+        if decoded is not None:
+            del xyz, mm
+            return open_depth_product(decoded)
+    return label, xyz, None
+
+
+def read_xyz_block(xyz, valid, start, stop):
+    # Lines start:stop of an opened depth product as a float32 (3, lines, samples) array
+    # with invalid samples set to 0, and their (lines, samples) valid mask
+    block = np.array(xyz[:, start:stop], dtype=np.float32)
+    if valid is None:
+        block_valid = np.isfinite(block).all(axis=0) & (block != 0.0).any(axis=0)
+    else:
+        block_valid = np.array(valid[start:stop], dtype=bool)
+    block[:, ~block_valid] = 0.0
+    return block, block_valid
+
+
+# -----------------------------------------------------------------------------
+# Mesh arrays: the geometry handed to Blender, built from a decoded XYZ product.
+# They are cached per product and geometry options under MarsRoverImages/meshcache/.
+
+MESH_CACHE_VERSION = 3
+
+# geometry options of create_mesh_from_depthimage
+DEFAULT_GEOMETRY = {
+    'fill': True,
+    'fill_direction': 'VERTICAL',  # VERTICAL, HORIZONTAL or BOTH
+    'fill_gap': 0,  # longest gap to fill, in samples; 0 = any
+    'fill_length': 6.0,  # longest bridge, in metres
+    'resolution': 1,  # keep 1 / resolution of the samples in each direction
+    'downsample': 'STRIDE',  # STRIDE or AVERAGE
+    'tolerance': 0.0,  # adaptive triangle mesh error bound, in metres; 0 = regular quad grid
+    'max_range': 0.0,  # drop samples farther from the rover origin, in metres; 0 = off
+    'max_edge': 0.0,  # drop faces with a longer edge, in metres; 0 = off
+    'max_depth_ratio': 0.0,  # drop faces whose far/near corner range ratio is higher; 0 = off, else >= 1
+    'points': False,  # vertices only: no fill, faces or uvs
+}
+
+
+def fill_gaps_along_lines(xyz, valid, max_gap, max_length, index=None):
+    # Bridge gaps down each column of a (3, lines, samples) array, in place. Every missing
+    # sample between two valid ones is linearly interpolated from them, if the gap is at
+    # most max_gap samples long (0 = any length) and the ends are closer than max_length.
+    # index: (lines, samples) line number of every sample, when the rows are not
+    # consecutive lines, see fill_gaps_down_block()
+    lines = valid.shape[0]
+    row = np.arange(lines)[:, np.newaxis]
+
+    # nearest valid row above and below every sample
+    above = np.maximum.accumulate(np.where(valid, row, -1), axis=0)
+    below = np.minimum.accumulate(np.where(valid, row, lines)[::-1], axis=0)[::-1]
+
+    holes = ~valid & (above >= 0) & (below < lines)
+    j, k = np.nonzero(holes)
+    a = above[j, k]
+    b = below[j, k]
+    start = xyz[:, a, k]
+    span = xyz[:, b, k] - start
+
+    if index is None:
+        line, line_a, line_b = j, a, b
+    else:
+        line, line_a, line_b = index[j, k], index[a, k], index[b, k]
+
+    bridged = np.sqrt((span * span).sum(axis=0)) < max_length
+    if max_gap > 0:
+        bridged &= (line_b - line_a - 1) <= max_gap
+    j, k = j[bridged], k[bridged]
+    line, line_a, line_b = line[bridged], line_a[bridged], line_b[bridged]
+
+    xyz[:, j, k] = start[:, bridged] + span[:, bridged] * ((line - line_a) / (line_b - line_a)).astype(np.float32)
+    valid[j, k] = True
+
+
+def fill_gaps(xyz, valid, direction='VERTICAL', max_gap=0, max_length=6.0):
+    # Fill gaps in the xyz data along columns (VERTICAL), rows (HORIZONTAL) or both,
+    # columns first. max_length is in metres. Returns new (xyz, valid) arrays.
+    xyz = xyz.copy()
+    valid = valid.copy()
+
+    if direction in ('VERTICAL', 'BOTH'):
+        fill_gaps_along_lines(xyz, valid, max_gap, max_length)
+    if direction in ('HORIZONTAL', 'BOTH'):
+        fill_gaps_along_lines(xyz.transpose(0, 2, 1), valid.T, max_gap, max_length)
+
+    return xyz, valid
+
+
+# Quad topology of the grid sizes in use, least recently used first
+grid_templates = {}
+GRID_TEMPLATE_BUDGET = 64 << 20  # bytes
+
+
+def get_grid_template(lines, line_samples):
+    # Topology of a full lines x line_samples grid, shared by all products of that size:
+    #   faces: (F, 4) int32 vertex indices per quad (also the loop to vertex map)
+    key = (lines, line_samples)
+    template = grid_templates.pop(key, None)
+    if template is None:
+        grid = np.arange(lines * line_samples, dtype=np.int32).reshape(lines, line_samples)
+        faces = np.stack((grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]), axis=-1).reshape(-1, 4)
+        faces.setflags(write=False)
+        template = {'faces': faces}
+
+    # most recently used last; evict from the front, but keep the one just asked for
+    grid_templates[key] = template
+    total = sum(cached['faces'].nbytes for cached in grid_templates.values())
+    while total > GRID_TEMPLATE_BUDGET and len(grid_templates) > 1:
+        oldest = next(iter(grid_templates))
+        total -= grid_templates.pop(oldest)['faces'].nbytes
+    return template
+
+
+def grid_uvs(indices, line_samples, full_shape, factor=1, offset=0.0):
+    # Texture coordinates of grid vertices, given by their index in a grid of line_samples
+    # samples per line, downsampled by factor (first sample at offset) from full_shape:
+    # (len(indices), 2) float32 coordinates on the full resolution texture
+    LINES, LINE_SAMPLES = full_shape
+    lines, samples = np.divmod(indices, line_samples)
+    uvs = np.empty((len(indices), 2), dtype=np.float32)
+    uvs[:, 0] = (samples * factor + offset) / LINE_SAMPLES
+    uvs[:, 1] = 1.0 - (lines * factor + offset) / LINES
+    return uvs
+
+
+def downsample_xyz(xyz, valid, factor, method='STRIDE'):
+    # Reduce the grid by an integer factor, either by keeping every factor-th sample
+    # (STRIDE) or by averaging the valid samples of each factor x factor block (AVERAGE).
+    # Returns (xyz, valid, offset), offset being the position of the first coarse sample
+    # in full resolution samples.
+    if factor <= 1:
+        return xyz, valid, 0.0
+
+    if method == 'AVERAGE':
+        lines, line_samples = valid.shape[0] // factor, valid.shape[1] // factor
+        blocks = xyz[:, :lines * factor, :line_samples * factor].reshape(3, lines, factor, line_samples, factor)
+        weights = valid[:lines * factor, :line_samples * factor].reshape(lines, factor, line_samples, factor)
+
+        count = weights.sum(axis=(1, 3))
+        sums = (blocks * weights).sum(axis=(2, 4), dtype=np.float64)
+        coarse = (sums / np.maximum(count, 1)).astype(np.float32)
+        return coarse, count > 0, (factor - 1) / 2.0
+
+    return np.ascontiguousarray(xyz[:, ::factor, ::factor]), np.ascontiguousarray(valid[::factor, ::factor]), 0.0
+
+
+def rover_to_blender(xyz):
+    # (3, lines, samples) rover frame metres -> (lines * samples, 3) Blender units.
+    # Rover Z axis points downwards, hence invert Z
+    positions = np.empty(xyz.shape[1:] + (3,), dtype=np.float32)
+    positions[:, :, 0] = xyz[1]
+    positions[:, :, 1] = xyz[0]
+    positions[:, :, 2] = -xyz[2]
+    positions *= 0.1
+    return positions.reshape(-1, 3)
+
+
+def rtin_children(triangles):
+    # Split right triangles (ax, ay, bx, by, cx, cy), a-b being the hypotenuse and c the
+    # right angle corner, at the middle m of the hypotenuse into (c, a, m) and (b, c, m)
+    ax, ay, bx, by, cx, cy = triangles.T
+    mx = (ax + bx) // 2
+    my = (ay + by) // 2
+    return np.concatenate((np.stack((cx, cy, ax, ay, mx, my), axis=-1),
+                           np.stack((bx, by, cx, cy, mx, my), axis=-1)))
+
+
+def rtin_triangle_errors(points, ok, triangles, chunk=1 << 20):
+    # Largest distance of the samples covered by each triangle (ax, ay, bx, by, cx, cy) of
+    # a (size + 1, size + 1, 3) grid from the plane interpolated between its corners, inf
+    # where one of them is invalid. Triangles of one RTIN level share their shape, so every
+    # one tests the same bounding box of samples, chunk samples at a time.
+    errors = np.zeros(len(triangles), dtype=np.float32)
+    if len(triangles) == 0:
+        return errors
+
+    ax, ay, bx, by, cx, cy = triangles.T.astype(np.int64)
+    x0 = np.minimum(np.minimum(ax, bx), cx)
+    y0 = np.minimum(np.minimum(ay, by), cy)
+    width = int((np.maximum(np.maximum(ax, bx), cx) - x0).max()) + 1
+    height = int((np.maximum(np.maximum(ay, by), cy) - y0).max()) + 1
+    oy, ox = np.divmod(np.arange(width * height), width)
+
+    step = max(1, chunk // len(ox))
+    for t in range(0, len(triangles), step):
+        a = (ax[t:t + step, np.newaxis], ay[t:t + step, np.newaxis])
+        b = (bx[t:t + step, np.newaxis], by[t:t + step, np.newaxis])
+        c = (cx[t:t + step, np.newaxis], cy[t:t + step, np.newaxis])
+        px = x0[t:t + step, np.newaxis] + ox
+        py = y0[t:t + step, np.newaxis] + oy
+
+        # barycentric weights of the samples, from exact integer cross products
+        area = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+        wa = (b[0] - px) * (c[1] - py) - (b[1] - py) * (c[0] - px)
+        wb = (c[0] - px) * (a[1] - py) - (c[1] - py) * (a[0] - px)
+        wc = area - wa - wb
+        inside = (wa * area >= 0) & (wb * area >= 0) & (wc * area >= 0)
+        px = np.where(inside, px, c[0])
+        py = np.where(inside, py, c[1])
+
+        surface = (points[a[1], a[0]] * (wa / area)[..., np.newaxis] +
+                   points[b[1], b[0]] * (wb / area)[..., np.newaxis] +
+                   points[c[1], c[0]] * (wc / area)[..., np.newaxis])
+        distance = np.sqrt(((points[py, px] - surface) ** 2).sum(axis=-1))
+        distance[~ok[py, px]] = np.inf
+        distance[~inside] = 0.0
+        errors[t:t + step] = distance.max(axis=1)
+    return errors
+
+
+def rtin_triangles(xyz, valid, tolerance):
+    # Error-bounded adaptive triangulation of the grid, a right-triangulated irregular
+    # network (RTIN) as in Mapbox's Martini. A triangle is split as long as the sample at
+    # the middle of its hypotenuse, or any sample of its sub-triangles, lies farther than
+    # tolerance (metres) from the interpolated surface, or its area holds invalid samples.
+    # The split rule keeps the mesh free of cracks. That alone does not bound the distance
+    # of the other samples, so the triangles kept are then checked against every sample
+    # they cover, and the mesh built again with those over tolerance split, until none is.
+    # Returns (F, 3) vertex indices in the lines x line_samples grid.
+    lines, line_samples = valid.shape
+    size = 1
+    while size < max(lines, line_samples) - 1:
+        size *= 2
+
+    # pad to a (2^k + 1) square grid with invalid samples
+    points = np.zeros((size + 1, size + 1, 3), dtype=np.float32)
+    points[:lines, :line_samples] = xyz.transpose(1, 2, 0)
+    ok = np.zeros((size + 1, size + 1), dtype=bool)
+    ok[:lines, :line_samples] = valid
+
+    # triangles of every level that can still be split, coarsest first
+    levels = []
+    triangles = np.array([[0, 0, size, size, size, 0], [size, size, 0, 0, 0, size]], dtype=np.int32)
+    while (triangles[0, 0] + triangles[0, 2]) % 2 == 0 and (triangles[0, 1] + triangles[0, 3]) % 2 == 0:
+        levels.append(triangles)
+        triangles = rtin_children(triangles)
+
+    # error of the middle of the hypotenuse of every triangle
+    middle_errors = []
+    for triangles in levels:
+        ax, ay, bx, by, cx, cy = triangles.T
+        mx = (ax + bx) // 2
+        my = (ay + by) // 2
+        middle = (points[ay, ax] + points[by, bx]) * 0.5 - points[my, mx]
+        error = np.sqrt((middle * middle).sum(axis=1))
+        error[~(ok[ay, ax] & ok[by, bx] & ok[cy, cx] & ok[my, mx])] = np.inf
+        middle_errors.append(error)
+
+    # split points of triangles found over tolerance, and triangles found within it
+    forced = np.zeros((size + 1, size + 1), dtype=bool)
+    checked = np.zeros((2, size + 1, size + 1), dtype=bool)
+    while True:
+        # error of each split point, finest level first, including the errors of its sub-triangles
+        errors = np.zeros((size + 1, size + 1), dtype=np.float32)
+        for depth in range(len(levels) - 1, -1, -1):
+            ax, ay, bx, by, cx, cy = levels[depth].T
+            mx = (ax + bx) // 2
+            my = (ay + by) // 2
+
+            error = np.where(forced[my, mx], np.inf, middle_errors[depth])
+            if depth < len(levels) - 1:
+                error = np.maximum(error, errors[(cy + ay) // 2, (cx + ax) // 2])
+                error = np.maximum(error, errors[(by + cy) // 2, (bx + cx) // 2])
+
+            np.maximum.at(errors, (my, mx), error)
+
+        # keep the coarsest triangles within tolerance
+        faces = []
+        over = 0
+        triangles = levels[0]
+        while len(triangles):
+            ax, ay, bx, by, cx, cy = triangles.T
+            if (ax[0] + bx[0]) % 2 or (ay[0] + by[0]) % 2:
+                # smallest triangles, no sample but their corners: keep those with three valid corners
+                faces.append(triangles[ok[ay, ax] & ok[by, bx] & ok[cy, cx]])
+                break
+
+            split = errors[(ay + by) // 2, (ax + bx) // 2] > tolerance
+            kept = triangles[~split]
+            faces.append(kept)
+            triangles = rtin_children(triangles[split])
+
+            # every sample of the triangles kept, once per triangle: a triangle is given by
+            # the middle of its hypotenuse and the side of it its right angle corner is on
+            ax, ay, bx, by, cx, cy = kept.T
+            mx = (ax + bx) // 2
+            my = (ay + by) // 2
+            side = ((cx > mx) | ((cx == mx) & (cy > my))).astype(np.intp)
+            new = ~checked[side, my, mx]
+            failed = rtin_triangle_errors(points, ok, kept[new]) > tolerance
+            checked[side[new][~failed], my[new][~failed], mx[new][~failed]] = True
+            forced[my[new][failed], mx[new][failed]] = True
+            over += int(failed.sum())
+
+        if over == 0:
             break
-        tmp = line.split("=")
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE":
-            block = "IMAGE"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE":
-            block = ""
-        if tmp[0].strip() == "OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = "IMAGE_HEADER"
-        elif tmp[0].strip() == "END_OBJECT" and tmp[1].strip() == "IMAGE_HEADER":
-            block = ""
-        if tmp[0].strip() == "GROUP" and tmp[1].strip() == "ROVER_COORDINATE_SYSTEM":
-            block = "ROVER_COORDINATE_SYSTEM"
-        elif tmp[0].strip() == "END_GROUP" and tmp[1].strip() == "ROVER_COORDINATE_SYSTEM":
-            block = ""
-
-        elif tmp[0].strip() == "START_TIME":
-            creation_date = str(tmp[1].strip())
-
-        if block == "IMAGE":
-            if line.find("LINES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINES = int(tmp[1].strip())
-            elif line.find("LINE_SAMPLES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                LINE_SAMPLES = int(tmp[1].strip())
-            elif line.find("SAMPLE_TYPE") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_TYPE = tmp[1].strip()
-            elif line.find("SAMPLE_BITS") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                SAMPLE_BITS = int(tmp[1].strip())
-
-        if block == "IMAGE_HEADER":
-            if line.find("BYTES") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                BYTES = int(tmp[1].strip())
-
-        if block == "ROVER_COORDINATE_SYSTEM":
-            if line.find("ORIGIN_OFFSET_VECTOR") != -1 and not(line.startswith("/*")):
-                tmp = line.split("=")
-                ORIGIN_OFFSET_VECTOR = str(tmp[1].strip())
-
-                fline = re.sub('[(!@#$)]', '', ORIGIN_OFFSET_VECTOR)
-                pf = fline.strip().split(",")
-
-                bRoverVec[:] = float(pf[1]), float(pf[0]), -float(pf[2])
-
-    f.close
-
-    # Open the img label file (binary data part)
+
+    triangles = np.concatenate(faces)
+    ax, ay, bx, by, cx, cy = triangles.T
+
+    # same winding as the quads of the regular grid
+    flip = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax) < 0
+    corners = np.stack((ay * line_samples + ax, by * line_samples + bx, cy * line_samples + cx), axis=-1)
+    corners[flip] = corners[flip][:, ::-1]
+    return corners.astype(np.int32)
+
+
+def sample_ranges(xyz, origin=None):
+    # Distance in metres of every sample of a (3, lines, samples) array from the origin
+    if origin is not None:
+        xyz = xyz - np.asarray(origin, dtype=np.float32).reshape(3, 1, 1)
+    return np.sqrt((xyz * xyz).sum(axis=0))
+
+
+def occlusion_edge_filter(xyz, faces, origin, max_edge, max_depth_ratio):
+    # Mask of the faces to keep: faces stretched across a depth discontinuity ("curtains")
+    # have an edge longer than max_edge metres, or corners whose distances from the origin
+    # differ by more than max_depth_ratio. A limit of 0 disables that test; a depth ratio
+    # below 1 would drop every face and disables it as well.
+    points = xyz.reshape(3, -1).T[faces]
+    keep = np.ones(len(faces), dtype=bool)
+
+    if max_edge > 0.0:
+        edges = points - np.roll(points, 1, axis=1)
+        keep &= (edges * edges).sum(axis=2).max(axis=1) <= max_edge * max_edge
+
+    if max_depth_ratio >= 1.0:
+        ranges = sample_ranges(xyz, origin).ravel()[faces]
+        keep &= ranges.max(axis=1) <= ranges.min(axis=1) * max_depth_ratio
+
+    return keep
+
+
+def build_mesh_arrays(xyz, valid, geometry, origin=None):
+    # origin: (x, y, z) rover origin in the frame of xyz, for the range cutoff
+    # Returns a dict of
+    #   positions: (N, 3) float32 vertex positions in Blender units
+    #   faces:     (F, 4) int32 vertex indices per quad, (F, 3) per triangle when adaptive
+    #   uvs:       (F * corners, 2) float32 texture coordinates per face corner (loop)
+    #   remap:     (N,) int32 index of each vertex in the (downsampled) grid
+    # or, for points only, positions, remap and
+    #   point_uvs: (N, 2) float32 texture coordinates per vertex
+    LINES, LINE_SAMPLES = valid.shape
+
+    if geometry['max_range'] > 0.0:
+        valid = valid & (sample_ranges(xyz, origin) <= geometry['max_range'])
+
+    factor = geometry['resolution']
+    xyz, valid, offset = downsample_xyz(xyz, valid, factor, geometry['downsample'])
+    lines, line_samples = valid.shape
+
+    if geometry['points']:
+        return build_point_arrays(xyz, valid, factor, offset, (LINES, LINE_SAMPLES))
+
+    if geometry['fill']:
+        # the max gap is given in full resolution pixels
+        max_gap = -(-geometry['fill_gap'] // factor)
+        xyz, valid = fill_gaps(xyz, valid, geometry['fill_direction'], max_gap, geometry['fill_length'])
+
+    positions = rover_to_blender(xyz)
+
+    if geometry['tolerance'] > 0.0:
+        faces = rtin_triangles(xyz, valid, geometry['tolerance'])
+    else:
+        # only quads with xyz data on all four corners
+        quads = (valid[:-1, :-1] & valid[:-1, 1:] & valid[1:, 1:] & valid[1:, :-1]).ravel()
+        faces = get_grid_template(lines, line_samples)['faces'][quads]
+
+    if geometry['max_edge'] > 0.0 or geometry['max_depth_ratio'] >= 1.0:
+        keep = occlusion_edge_filter(xyz, faces, origin, geometry['max_edge'], geometry['max_depth_ratio'])
+        faces = faces[keep]
+
+    # one per face corner; a downsampled grid still maps onto the full resolution texture
+    uvs = grid_uvs(faces.ravel(), line_samples, (LINES, LINE_SAMPLES), factor, offset)
+
+    # compact the vertices: keep those used by a face and renumber the faces
+    used = np.zeros(lines * line_samples, dtype=bool)
+    used[faces.ravel()] = True
+    remap = np.flatnonzero(used).astype(np.int32)
+    new_index = np.full(lines * line_samples, -1, dtype=np.int32)
+    new_index[remap] = np.arange(len(remap), dtype=np.int32)
+
+    return {'positions': positions[remap], 'faces': new_index[faces], 'uvs': uvs, 'remap': remap}
+
+
+def can_build_blocked(geometry):
+    # Everything but the adaptive mesh works on line blocks: it subdivides the whole grid
+    return geometry['tolerance'] == 0.0
+
+
+def grid_shape(lines, line_samples, factor, method='STRIDE'):
+    # Shape of the grid downsample_xyz() makes of a lines x line_samples one
+    if factor > 1 and method == 'AVERAGE':
+        return lines // factor, line_samples // factor
+    return -(-lines // factor), -(-line_samples // factor)
+
+
+def read_grid_lines(xyz, valid, geometry, origin, line0, line1):
+    # Grid lines line0:line1 of an opened depth product, with the range cutoff and
+    # downsampling of build_mesh_arrays() but no gap filling
+    factor = geometry['resolution']
+    if geometry['downsample'] == 'STRIDE':
+        # only read the samples kept
+        if valid is not None:
+            valid = valid[::factor, ::factor]
+        block, block_valid = read_xyz_block(xyz[:, ::factor, ::factor], valid, line0, line1)
+        offset = 0.0
+    else:
+        block, block_valid = read_xyz_block(xyz, valid, line0 * factor, line1 * factor)
+
+    if geometry['max_range'] > 0.0:
+        block_valid &= sample_ranges(block, origin) <= geometry['max_range']
+
+    if geometry['downsample'] != 'STRIDE':
+        block, block_valid, offset = downsample_xyz(block, block_valid, factor, geometry['downsample'])
+    return block[:, :line1 - line0], block_valid[:line1 - line0], offset
+
+
+def column_ends(grid, grid_valid, line0, last=False):
+    # (line, xyz) of the first (or last) valid sample down each column of grid lines
+    # starting at line0; line is -1 where a column has none
+    line_samples = grid_valid.shape[1]
+    if not len(grid_valid):
+        return np.full(line_samples, -1), np.zeros((3, line_samples), dtype=np.float32)
+
+    if last:
+        row = len(grid_valid) - 1 - grid_valid[::-1].argmax(axis=0)
+    else:
+        row = grid_valid.argmax(axis=0)
+    line = np.where(grid_valid.any(axis=0), row + line0, -1)
+    return line, grid[:, row, np.arange(line_samples)]
+
+
+def merge_column_ends(ends, fallback):
+    # column_ends() taken from fallback where ends has none
+    line, xyz = ends
+    missing = line < 0
+    return np.where(missing, fallback[0], line), np.where(missing, fallback[1], xyz)
+
+
+def fill_gaps_down_block(grid, grid_valid, line0, above, below, max_gap, max_length):
+    # fill_gaps(..., 'VERTICAL', ...) of grid lines starting at line0 of a taller grid,
+    # given the column_ends() of its lines above and below them. Returns new arrays.
+    lines, line_samples = grid_valid.shape
+    grid = np.concatenate((above[1][:, np.newaxis], grid, below[1][:, np.newaxis]), axis=1)
+    grid_valid = np.concatenate(((above[0] >= 0)[np.newaxis], grid_valid, (below[0] >= 0)[np.newaxis]))
+    index = np.concatenate((above[0][np.newaxis],
+                            np.repeat(np.arange(line0, line0 + lines)[:, np.newaxis], line_samples, axis=1),
+                            below[0][np.newaxis]))
+
+    fill_gaps_along_lines(grid, grid_valid, max_gap, max_length, index)
+    return grid[:, 1:-1], grid_valid[1:-1]
+
+
+def grid_blocks(xyz, valid, geometry, origin=None, block_lines=256):
+    # The grid of build_mesh_arrays() for an opened depth product, see open_depth_product(),
+    # block_lines full resolution lines at a time. Yields (line0, line1, grid, grid_valid,
+    # offset) per block: grid lines line0:line1 plus the first line of the next block, for
+    # the faces in between. Gap filling down the columns carries the last valid sample of
+    # each column from block to block, and finds the next one below the block by reading
+    # the max gap lines past it; when gaps of any length, or longer than a block, are
+    # filled, a first pass from the bottom up records them for every block instead.
+    factor = geometry['resolution']
+    lines, line_samples = grid_shape(xyz.shape[1], xyz.shape[2], factor, geometry['downsample'])
+    block_lines = max(1, block_lines // factor)
+    starts = range(0, lines, block_lines)
+
+    fill = geometry['fill'] and not geometry['points']
+    max_gap = -(-geometry['fill_gap'] // factor)
+    vertical = fill and geometry['fill_direction'] in ('VERTICAL', 'BOTH')
+    horizontal = fill and geometry['fill_direction'] in ('HORIZONTAL', 'BOTH')
+
+    no_ends = (np.full(line_samples, -1), np.zeros((3, line_samples), dtype=np.float32))
+    above = no_ends
+    belows = None
+    if vertical and (max_gap == 0 or max_gap > block_lines):
+        # column_ends() from the second line of every block on, the next block's own
+        # lines being followed by that of the block after
+        belows = [no_ends] * len(starts)
+        below = no_ends
+        for block in reversed(range(len(starts))):
+            line0 = starts[block]
+            grid, grid_valid, offset = read_grid_lines(xyz, valid, geometry, origin, line0,
+                                                       min(line0 + block_lines, lines))
+            if block > 0:
+                belows[block - 1] = merge_column_ends(column_ends(grid[:, 1:], grid_valid[1:], line0 + 1), below)
+            below = merge_column_ends(column_ends(grid, grid_valid, line0), below)
+
+    for block, line0 in enumerate(starts):
+        line1 = min(line0 + block_lines, lines)
+        stop = min(line1 + 1, lines)
+        grid, grid_valid, offset = read_grid_lines(xyz, valid, geometry, origin, line0, stop)
+
+        if vertical:
+            if belows is not None:
+                below = belows[block]
+            else:
+                ahead, ahead_valid, _ = read_grid_lines(xyz, valid, geometry, origin, stop, min(stop + max_gap, lines))
+                below = column_ends(ahead, ahead_valid, stop)
+            ends = column_ends(grid[:, :line1 - line0], grid_valid[:line1 - line0], line0, last=True)
+            grid, grid_valid = fill_gaps_down_block(grid, grid_valid, line0, above, below, max_gap, geometry['fill_length'])
+            above = merge_column_ends(ends, above)
+        if horizontal:
+            grid, grid_valid = fill_gaps(grid, grid_valid, 'HORIZONTAL', max_gap, geometry['fill_length'])
+
+        yield line0, line1, grid, grid_valid, offset
+
+
+def build_mesh_arrays_blocked(xyz, valid, geometry, origin=None, block_lines=256):
+    # build_mesh_arrays() for an opened depth product, block by block, see grid_blocks(),
+    # for geometry accepted by can_build_blocked(). A first pass only counts the faces and
+    # vertices to keep, so that the second one writes every block straight into arrays of
+    # the final size: besides these, the peak memory is a few bool masks of the grid and
+    # the arrays of one block.
+    LINES, LINE_SAMPLES = xyz.shape[1:]
+    factor = geometry['resolution']
+    lines, line_samples = grid_shape(LINES, LINE_SAMPLES, factor, geometry['downsample'])
+
+    # first pass: faces to keep and vertices they use
+    keep_quads = np.zeros((max(lines - 1, 0), max(line_samples - 1, 0)), dtype=bool)
+    used = np.zeros((lines, line_samples), dtype=bool)
+    for line0, line1, grid, grid_valid, offset in grid_blocks(xyz, valid, geometry, origin, block_lines):
+        grid_lines = len(grid_valid)
+        if grid_lines < 2:
+            continue
+
+        quads = grid_valid[:-1, :-1] & grid_valid[:-1, 1:] & grid_valid[1:, 1:] & grid_valid[1:, :-1]
+        if geometry['max_edge'] > 0.0 or geometry['max_depth_ratio'] >= 1.0:
+            faces = get_grid_template(grid_lines, line_samples)['faces'].reshape(quads.shape + (4,))
+            quads[quads] = occlusion_edge_filter(grid, faces[quads], origin, geometry['max_edge'], geometry['max_depth_ratio'])
+
+        keep_quads[line0:line0 + grid_lines - 1] = quads
+        block_used = used[line0:line0 + grid_lines]
+        block_used[:-1, :-1] |= quads
+        block_used[:-1, 1:] |= quads
+        block_used[1:, 1:] |= quads
+        block_used[1:, :-1] |= quads
+
+    # vertices are numbered in grid order, as compacted by build_mesh_arrays()
+    line_counts = used.sum(axis=1)
+    first_vertex = np.concatenate(([0], np.cumsum(line_counts)))
+    face_counts = keep_quads.sum(axis=1)
+    first_face = np.concatenate(([0], np.cumsum(face_counts)))
+
+    positions = np.empty((first_vertex[-1], 3), dtype=np.float32)
+    remap = np.empty(first_vertex[-1], dtype=np.int32)
+    faces = np.empty((first_face[-1], 4), dtype=np.int32)
+    uvs = np.empty((first_face[-1] * 4, 2), dtype=np.float32)
+
+    # second pass: fill in the blocks
+    for line0, line1, grid, grid_valid, offset in grid_blocks(xyz, valid, geometry, origin, block_lines):
+        grid_lines = len(grid_valid)
+
+        owned_used = used[line0:line1].ravel()
+        vertex0, vertex1 = first_vertex[line0], first_vertex[line1]
+        positions[vertex0:vertex1] = rover_to_blender(grid[:, :line1 - line0])[owned_used]
+        remap[vertex0:vertex1] = np.flatnonzero(owned_used) + line0 * line_samples
+
+        if grid_lines < 2:
+            continue
+        quads = keep_quads[line0:line0 + grid_lines - 1]
+        block_faces = get_grid_template(grid_lines, line_samples)['faces'].reshape(quads.shape + (4,))[quads]
+
+        # block vertex index -> mesh vertex index
+        new_index = np.cumsum(used[line0:line0 + grid_lines].ravel(), dtype=np.int32) + (vertex0 - 1)
+        face0, face1 = first_face[line0], first_face[line0 + grid_lines - 1]
+        faces[face0:face1] = new_index[block_faces]
+
+        # texture coordinates of the full resolution texture, as in build_mesh_arrays()
+        uvs[face0 * 4:face1 * 4] = grid_uvs(block_faces.ravel() + line0 * line_samples, line_samples,
+                                            (LINES, LINE_SAMPLES), factor, offset)
+
+    return {'positions': positions, 'faces': faces, 'uvs': uvs, 'remap': remap}
+
+
+def build_point_arrays_blocked(xyz, valid, geometry, origin=None, block_lines=256):
+    # build_point_arrays() for an opened depth product, block by block in two passes as
+    # build_mesh_arrays_blocked(): the first one counts the valid samples of each block
+    LINES, LINE_SAMPLES = xyz.shape[1:]
+    factor = geometry['resolution']
+    line_samples = grid_shape(LINES, LINE_SAMPLES, factor, geometry['downsample'])[1]
+
+    counts = [grid_valid[:line1 - line0].sum()
+              for line0, line1, grid, grid_valid, offset in grid_blocks(xyz, valid, geometry, origin, block_lines)]
+    first_point = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+    positions = np.empty((first_point[-1], 3), dtype=np.float32)
+    remap = np.empty(first_point[-1], dtype=np.int32)
+    point_uvs = np.empty((first_point[-1], 2), dtype=np.float32)
+
+    blocks = grid_blocks(xyz, valid, geometry, origin, block_lines)
+    for block, (line0, line1, grid, grid_valid, offset) in enumerate(blocks):
+        owned_valid = grid_valid[:line1 - line0].ravel()
+        point0, point1 = first_point[block], first_point[block + 1]
+        positions[point0:point1] = rover_to_blender(grid[:, :line1 - line0])[owned_valid]
+        remap[point0:point1] = np.flatnonzero(owned_valid) + line0 * line_samples
+        point_uvs[point0:point1] = grid_uvs(remap[point0:point1], line_samples, (LINES, LINE_SAMPLES), factor, offset)
+
+    return {'positions': positions, 'point_uvs': point_uvs, 'remap': remap}
+
+
+def build_point_arrays(xyz, valid, factor, offset, full_shape):
+    # Valid samples only, with the texture coordinate of their full resolution pixel
+    lines, line_samples = valid.shape
+
+    remap = np.flatnonzero(valid).astype(np.int32)
+    positions = rover_to_blender(xyz).reshape(-1, 3)[remap]
+
+    point_uvs = grid_uvs(remap, line_samples, full_shape, factor, offset)
+
+    return {'positions': positions, 'point_uvs': point_uvs, 'remap': remap}
+
+
+def sample_image_intensity(image, uvs):
+    # Nearest pixel intensity (mean of the colour channels, 0..1) of a Blender image at uvs
+    width, height = image.size
+    channels = image.channels
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, channels)
+
+    # Blender images start at the bottom row
+    columns = np.minimum((uvs[:, 0] * width).astype(np.int32), width - 1)
+    rows = height - 1 - np.minimum(((1.0 - uvs[:, 1]) * height).astype(np.int32), height - 1)
+    samples = pixels[rows, columns, :min(channels, 3)]
+    return samples.mean(axis=1)
+
+
+def add_mesh_attribute(mesh, name, domain, values):
+    # FLOAT or INT attribute set in bulk from an array
+    values = np.ascontiguousarray(values)
+    attribute_type = 'INT' if values.dtype.kind in 'iu' else 'FLOAT'
+    attribute = mesh.attributes.new(name=name, type=attribute_type, domain=domain)
+    attribute.data.foreach_set('value', values)
+
+
+def mesh_cache_filename(label, geometry):
+    # The product ID carries the product version; the key also covers the geometry options
+    # and the precision of the decoded XYZ cache, float16 moving the vertices
+    product_id = catalog_product_id(label.filename)
+    key = repr((MESH_CACHE_VERSION, product_id, sorted(geometry.items()), ('half', decoded_cache_half)))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(local_data_dir, 'meshcache', '%s-%s.npz' %(product_id, digest))
+
+
+def load_mesh_arrays(depth_filename, label, geometry):
+    # Cached mesh arrays, if they are at least as recent as the depth product
+    filename = mesh_cache_filename(label, geometry)
     try:
-        if FileAndExt[1].isupper():
-            f2 = open(FileAndExt[0] + ".IMG", 'rb')
-        else:
-            f2 = open(FileAndExt[0] + ".img", 'rb')
-    except:
-        return
+        if os.path.getmtime(filename) < os.path.getmtime(depth_filename):
+            return None
+        with np.load(filename) as data:
+            mesh_arrays = {name: data[name] for name in data.files}
+    except (IOError, OSError, ValueError):
+        return None
+
+    print('Mesh loaded from cache: ', filename)
+    return mesh_arrays
+
+
+def save_mesh_arrays(depth_filename, label, geometry, mesh_arrays):
+    filename = mesh_cache_filename(label, geometry)
+    try:
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename + '.part', 'wb') as f:
+            np.savez(f, **mesh_arrays)
+        os.replace(filename + '.part', filename)
+    except (IOError, OSError) as e:
+        print('Unable to cache mesh %s: %s' %(filename, e))
+
+
+def create_mesh_from_arrays(name, mesh_arrays, origin=None):
+    # Bulk mesh construction: vertices, loops and polygons are added at once and filled
+    # with foreach_set from flat contiguous arrays. Vertices are made relative to origin.
+    positions = np.ascontiguousarray(mesh_arrays['positions'], dtype=np.float32)
+    if origin is not None:
+        positions = positions - np.asarray(origin, dtype=np.float32)
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(positions))
+    mesh.vertices.foreach_set('co', positions.ravel())
+
+    # points only
+    if 'faces' not in mesh_arrays:
+        mesh.update()
+        return mesh
+
+    faces = np.ascontiguousarray(mesh_arrays['faces'], dtype=np.int32)
+    corners = faces.shape[1]
+
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces.size, corners, dtype=np.int32))
+    try:
+        mesh.polygons.foreach_set('loop_total', np.full(len(faces), corners, dtype=np.int32))
+    except (AttributeError, TypeError, RuntimeError):
+        pass  # read-only since Blender 4.0, derived from loop_start
 
-    edit = f2.read()
-    meh = edit.find(b'LBLSIZE')
-    f2.seek( meh + BYTES)
+    if 'material_indices' in mesh_arrays:
+        mesh.polygons.foreach_set('material_index', np.ascontiguousarray(mesh_arrays['material_indices'], dtype=np.int32))
 
-    # Create a list of bands containing an empty list for each band.
-    bands = []
+    # one texture coordinate per loop, in the same order as the faces
+    if 'uvs' in mesh_arrays:
+        uvs = np.ascontiguousarray(mesh_arrays['uvs'], dtype=np.float32)
+        mesh.uv_layers.new(name='UVMap').data.foreach_set('uv', uvs.ravel())
 
-    # Each band of the image contains a sequence of Float32 IEEE754 (4 bytes); byte order 
-    # is specified in PDS label and Vicar label at the beginning of the file.
-    # Band 0 = X, Band 1 = Y, Band 2 = Z.
-    # Band length = bytes_per_sample * lines * samples	= 4 * lines * samples
-	   
+    mesh.update(calc_edges=True)
+    return mesh
 
-    # Read data for each band at a time
-    for bandnum in range(0, 3):
-        bands.append([])
 
-        for linenum in range(0, LINES):
+def get_mesh_arrays(image_depth_filename, geometry, product=None):
+    # Mesh arrays of a depth product, from the mesh cache or built and cached.
+    # product is the (label, xyz, valid) of an earlier call, it saves decoding again.
+    # Returns (label, mesh_arrays, product); label is None on failure.
+    if is_decoded_product(image_depth_filename):
+        img_filename = img_filename_of_decoded(image_depth_filename)
+    else:
+        img_filename = image_depth_filename
+
+    label = label_for_product(img_filename)
+    if label is not None:
+        mesh_arrays = load_mesh_arrays(image_depth_filename, label, geometry)
+        if mesh_arrays is not None:
+            return label, mesh_arrays, product
+
+    if product is None and decode_block_lines > 0:
+        if can_build_blocked(geometry):
+            label, xyz, valid = open_depth_product(image_depth_filename)
+            if label is None:
+                return None, None, None
+            build = build_point_arrays_blocked if geometry['points'] else build_mesh_arrays_blocked
+            mesh_arrays = build(xyz, valid, geometry, label.ORIGIN_OFFSET_VECTOR, decode_block_lines)
+            del xyz, valid
+            save_mesh_arrays(image_depth_filename, label, geometry, mesh_arrays)
+            return label, mesh_arrays, None
+        print('Adaptive mesh: decoding the whole product')
+
+    if product is None:
+        product = load_depth_product(image_depth_filename)
+    label, xyz, valid = product
+    if label is None:
+        return None, None, None
+
+    mesh_arrays = build_mesh_arrays(xyz, valid, geometry, label.ORIGIN_OFFSET_VECTOR)
+    save_mesh_arrays(image_depth_filename, label, geometry, mesh_arrays)
+    return label, mesh_arrays, product
+
+
+def get_preview_arrays(image_depth_filename, geometry):
+    # Mesh arrays of a coarse preview, built in one block from the samples kept by a STRIDE
+    # downsampling of the opened depth product only, see read_grid_lines(). They are not
+    # cached: the full resolution mesh replaces them shortly.
+    # Returns (label, mesh_arrays); label is None on failure.
+    label, xyz, valid = open_depth_product(image_depth_filename)
+    if label is None:
+        return None, None
+
+    build = build_point_arrays_blocked if geometry['points'] else build_mesh_arrays_blocked
+    return label, build(xyz, valid, geometry, label.ORIGIN_OFFSET_VECTOR, xyz.shape[1])
+
+
+def add_lod_range(ob, camera, near, far):
+    # Show ob in the viewport only while the camera is between near and far (None =
+    # unbounded), as applied by update_lod_visibility()
+    ob['lod_camera'] = camera
+    ob['lod_near'] = -1.0 if near is None else near
+    ob['lod_far'] = -1.0 if far is None else far
+
+
+@bpy.app.handlers.persistent
+def update_lod_visibility(scene, depsgraph=None):
+    # depsgraph_update_post and frame_change_post handler switching the LOD levels made by
+    # add_lod_objects(). Not a driver on hide_viewport: an object hidden in the viewport is
+    # left out of the depsgraph, its driver with it, and would never show up again.
+    for ob in scene.objects:
+        camera = ob.get('lod_camera')
+        if camera is None or camera.name not in scene.objects:
+            continue
+        d = (ob.matrix_world.translation - camera.matrix_world.translation).length
+        hide = (0.0 <= ob['lod_far'] <= d) or d < ob['lod_near']
+        if ob.hide_viewport != hide:
+            ob.hide_viewport = hide
+
+
+def add_lod_objects(ob, collection, image_depth_filename, geometry, levels, distance, camera):
+    # Build 'levels' coarser copies of ob, level i at 2^i times its resolution divider, and
+    # switch between them on the distance to the camera, see update_lod_visibility(): ob
+    # itself is shown closer than distance (Blender units), level i from distance * 2^(i-1)
+    # to distance * 2^i, the last level beyond. Only ob is rendered.
+    product = None
+    for i in range(1, levels + 1):
+        lod_geometry = dict(geometry, resolution=geometry['resolution'] * 2 ** i)
+        label, mesh_arrays, product = get_mesh_arrays(image_depth_filename, lod_geometry, product)
+        if label is None:
+            return
 
-            bands[bandnum].append([])
+        mesh = create_mesh_from_arrays('%s-LOD%d' %(ob.name, i), mesh_arrays, tuple(ob.location))
+        for material in ob.data.materials:
+            mesh.materials.append(material)
 
-            for pixnum in range(0, LINE_SAMPLES):
+        lod_ob = bpy.data.objects.new(mesh.name, mesh)
+        lod_ob.location = ob.location.copy()
+        lod_ob.hide_render = True
+        collection.objects.link(lod_ob)
 
-                # Read one data item (pixel) from the data file.
-                dataitem = f2.read(4)
+        add_lod_range(lod_ob, camera, distance * 2 ** (i - 1), distance * 2 ** i if i < levels else None)
 
-                if (dataitem == ""):
-                    print ('ERROR, Ran out of data to read before we should have')
+    add_lod_range(ob, camera, None, distance)
+    update_lod_visibility(bpy.context.scene)
 
-                # If everything worked, unpack the binary value and store it in the appropriate pixel value
-                bands[bandnum][linenum].append(struct.unpack('>f', dataitem)[0])
 
-    f2.close
+def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_filename, do_fill, do_rad, texture_image=None, geometry=None,
+                                lod_levels=0, lod_distance=20.0, point_intensity=False, preview=False):
+    # snippets used from:
+    # https://svn.blender.org/svnroot/bf-extensions/contrib/py/scripts/addons/io_import_LRO_Lola_MGS_Mola_img.py
+    # https://arsf-dan.nerc.ac.uk/trac/attachment/wiki/Processing/SyntheticDataset/data_handler.py
+    # Returns (object, camera); camera is None when there is no texture, both on failure
 
-    Vertex = []
-    Faces = []
+    global curve_minval, curve_maxval
 
-    nulvec = Vector((0.0,0.0,0.0))
+    bRoverVec = Vector((0.0, 0.0, 0.0))
 
-    for j in range(0, LINES):
-        for k in range(0, LINE_SAMPLES):
-            vec = Vector((float(bands[1][j][k]), float(bands[0][j][k]), float(-bands[2][j][k])))  # Rover Z axis points downwards, hence invert Z
-            vec = vec*0.1
-            Vertex.append(vec)
+    if image_depth_filename == '':
+        return None, None
 
-    del bands
+    print('Creating mesh...')
+
+    # every option that changes the geometry goes in here, it is part of the mesh cache key
+    geometry = dict(DEFAULT_GEOMETRY, **(geometry or {}))
+    geometry['fill'] = bool(do_fill)
 
-    #simple dehole (bridge)
-    #max_fill_length = fill_length
-    max_fill_length = 0.6
-    if(do_fill):
-        for j in range(0, LINES-1):
-            for k in range(0, LINE_SAMPLES-1):
-                if Vertex[j * LINE_SAMPLES + k] != nulvec:
-                    m = 1
-                    while Vertex[(j + m) * LINE_SAMPLES + k] == nulvec and (j + m) < LINES-1:
-                        m = m + 1
+    if preview:
+        label, mesh_arrays = get_preview_arrays(image_depth_filename, geometry)
+    else:
+        label, mesh_arrays, product = get_mesh_arrays(image_depth_filename, geometry)
+        del product
+    if label is None:
+        return None, None
+
+    FileAndPath = label.filename
+    FileAndExt = os.path.splitext(FileAndPath)
 
-                    if m != 1 and Vertex[(j + m) * LINE_SAMPLES + k] != nulvec:
-                        VertexA = Vertex[j * LINE_SAMPLES + k]
-                        VertexB = Vertex[(j + m) * LINE_SAMPLES + k]
-                        sparevec = VertexB - VertexA
-                        if sparevec.length < max_fill_length:
-                            for n in range(0, m):
-                                Vertex[(j + n) * LINE_SAMPLES + k] = VertexA + (sparevec / m) * n
+    creation_date = label.START_TIME
 
-    for j in range(0, LINES-1):
-        for k in range(0, LINE_SAMPLES-1):
-            Faces.append(( (j * LINE_SAMPLES + k), (j * LINE_SAMPLES + k + 1), ((j + 1) * LINE_SAMPLES + k + 1), ((j + 1) * LINE_SAMPLES + k) ))
+    if label.ORIGIN_OFFSET_VECTOR is not None:
+        pf = label.ORIGIN_OFFSET_VECTOR
+        bRoverVec[:] = pf[1], pf[0], -pf[2]
 
     os.path.basename(FileAndExt[0])
     TARGET_NAME = '%s-%s' %(sol, os.path.basename(FileAndExt[0]))
-    mesh = bpy.data.meshes.new(TARGET_NAME)
+    # object origin at the median point of the geometry
+    if len(mesh_arrays['positions']):
+        center = mesh_arrays['positions'].mean(axis=0, dtype=np.float64)
+    else:
+        center = np.zeros(3)
+    mesh = create_mesh_from_arrays(TARGET_NAME, mesh_arrays, center)
     TARGET_NAME = mesh.name
-    mesh.from_pydata(Vertex, [], Faces)
-
-    del Vertex
-    del Faces
-    mesh.update()
 
 
     ob_new = bpy.data.objects.new(TARGET_NAME, mesh)
     ob_new.data = mesh
+    ob_new.location = center.tolist()
 
     theSolCollection = get_collection('Sol%s' %(sol))
     theSolCollection.objects.link(ob_new)
@@ -1144,15 +2719,23 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
     bpy.context.view_layer.objects.active = ob_new
 
     obj = bpy.context.object
+    cam_ob = None
 
     if image_texture_filename != None :
       ####### ADD TEXTURE ########
       print('Texturing mesh...')
       try:
-          with open(image_texture_filename):
-              img = bpy.data.images.load(image_texture_filename)
-              img.pack()
-
+          if texture_image == None:
+              with open(image_texture_filename):
+                  texture_image = bpy.data.images.load(image_texture_filename)
+                  texture_image.pack()
+          img = texture_image
+
+          if geometry['points']:
+              # no material for a point cloud, optionally the texture intensity per point
+              if point_intensity:
+                  add_mesh_attribute(obj.data, 'intensity', 'POINT', sample_image_intensity(img, mesh_arrays['point_uvs']))
+          else:
               engine = bpy.context.scene.render.engine
               if engine in {'CYCLES', 'BLENDER_EEVEE', 'BLENDER_OPENGL'}:
                   material = create_cycles_material(bpy.context, img)
@@ -1160,28 +2743,8 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
               # add material to object
               obj.data.materials.append(material)
 
-              me = obj.data
-              #me.show_double_sided = True
-              bpy.ops.mesh.uv_texture_add()
-
-              uvteller = 0
-
-              #per face !
-              for j in range(0, LINES -1):
-                  for k in range(0, LINE_SAMPLES-1):
-                      tc1 = Vector(((1.0 / LINE_SAMPLES) * k, 1.0 - (1.0 / LINES) * j))
-                      tc2 = Vector(((1.0 / LINE_SAMPLES) * (k + 1), 1.0 - (1.0 / LINES) * j))
-                      tc3 = Vector(((1.0 / LINE_SAMPLES) * (k + 1), 1.0 - (1.0 / LINES) * (j + 1)))
-                      tc4 = Vector(((1.0 / LINE_SAMPLES) * k, 1.0 - (1.0 / LINES) * (j + 1)))
-
-                      bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc1
-                      uvteller = uvteller + 1
-                      bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc2
-                      uvteller = uvteller + 1
-                      bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc3
-                      uvteller = uvteller + 1
-                      bpy.data.objects[TARGET_NAME].data.uv_layers[0].data[uvteller].uv = tc4
-                      uvteller = uvteller + 1
+          me = obj.data
+          #me.show_double_sided = True
 
       except IOError:
           print('Oh dear. Problems with %s' %(image_texture_filename))
@@ -1195,47 +2758,10 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
 ### TEXTURE END? ##############
 
 
-        ### Clenaup mesh #######
-
-        # remove verts lacking xyz data
-        bpy.ops.object.mode_set(mode='EDIT')
-        mesh_ob = bpy.context.object
-        me = mesh_ob.data
-        bm = bmesh.from_edit_mesh(me)
-
-        verts = [v for v in bm.verts if v.co[0] == 0.0 and v.co[1] == 0.0 and v.co[2] == 0.0]
-        bmesh.ops.delete(bm, geom=verts, context="VERTS")
-        bmesh.update_edit_mesh(me)
-
-        # remove redundant verts
-        bpy.ops.object.mode_set(mode='EDIT')
-        mesh_ob = bpy.context.object
-        me = mesh_ob.data
-        bm = bmesh.from_edit_mesh(me)
-
-        verts = [v for v in bm.verts if len(v.link_faces) == 0]
-        bmesh.ops.delete(bm, geom=verts, context="VERTS")
-        bmesh.update_edit_mesh(me)
-
-        bpy.ops.object.editmode_toggle()
-
-        bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY')
-        bpy.ops.object.mode_set(mode='OBJECT')
-
         # mesh generation completed, now add camera and caption:
 
         ##### Add camera ####
-        cam = bpy.data.cameras.new('Camera')
-        cam.lens = 40
-        cam.clip_start = 0.01
-        cam_ob = bpy.data.objects.new('Cam-' + os.path.basename(FileAndExt[0]), cam)
-
-        bRoverVec = bRoverVec * 0.1
-
-        mat_loc = mathutils.Matrix.Translation(bRoverVec)
-        mat_trans = mathutils.Matrix.Translation((0.0, 0.0, 0.15))
-
-        cam_ob.matrix_world = mat_loc @ mat_trans
+        cam_ob = add_rover_camera('Cam-' + os.path.basename(FileAndExt[0]), bRoverVec * 0.1, obj, theSolCollection)
 
         # Create Credit text
         trover = [ 'Spirit', 'Opportunity', 'Curiosity' ]
@@ -1291,16 +2817,6 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
 
         text_ob.data.materials.append(mat)
         text_ob.parent = cam_ob
-
-        objloc = Vector(mesh_ob.location)
-        rovloc = Vector(bRoverVec)
-        distvec = rovloc - objloc
-
-        expoint = obj.matrix_world.to_translation()+Vector((0.0, 0.0, -0.04-distvec.length*0.1))
-        look_at(cam_ob, expoint)
-
-        theSolCollection.objects.link(cam_ob)
-        bpy.context.scene.camera = cam_ob
         #bpy.context.scene.update()
 
         print ('Mesh generation complete. Note: you must turn on rendering or preview to see texture.')
@@ -1309,6 +2825,580 @@ def create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_
       print ('  ---  Texture not available, skipping...');
       #example : 2N295212876EFFB1DNP1950L0M1
 
+    # the LOD levels follow the camera of this product, made with the texture only
+    if lod_levels > 0 and cam_ob != None:
+        print('Creating %d LOD levels...' %(lod_levels))
+        add_lod_objects(obj, theSolCollection, image_depth_filename, geometry, lod_levels, lod_distance * 0.1, cam_ob)
+
+    return obj, cam_ob
+
+
+# Products imported as a coarse preview, waiting to be upgraded to full resolution by
+# upgrade_next_preview(), a bpy.app.timers callback, so Blender stays responsive in between
+pending_upgrades = []
+
+
+def redraw_now():
+    # Show what was created so far while the import is still running
+    try:
+        bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
+    except RuntimeError:
+        pass
+
+
+def queue_upgrade(upgrade):
+    pending_upgrades.append(upgrade)
+    if not bpy.app.timers.is_registered(upgrade_next_preview):
+        bpy.app.timers.register(upgrade_next_preview, first_interval=0.1)
+
+
+def upgrade_next_preview():
+    # One product per call; returning None unregisters the timer
+    if len(pending_upgrades) == 0:
+        return None
+
+    upgrade = pending_upgrades.pop(0)
+    try:
+        upgrade_preview(upgrade)
+    except Exception as e:
+        # an exception would unregister the timer and strand the other previews
+        print('Unable to upgrade %s: %s' %(upgrade['product_id'], e))
+
+    if len(pending_upgrades) == 0:
+        print('All previews upgraded.')
+        close_http_connections()
+        return None
+    return 0.0
+
+
+def upgrade_preview(upgrade):
+    # Full resolution mesh and texture for a product queued by ReadNavcamString. The new mesh
+    # replaces the preview mesh of the same object, which keeps its name, location and
+    # collection, and the camera and caption made with the preview. Products past the
+    # preview time budget have no preview object yet and are imported as usual.
+    global roverDataDir, roverImageDir, local_data_dir, curve_minval, curve_maxval
+
+    roverDataDir, roverImageDir, local_data_dir = upgrade['dirs']
+    rover, sol, product_id = upgrade['rover'], upgrade['sol'], upgrade['product_id']
+    print('Upgrading preview of %s...' %(product_id))
+
+    ob = None
+    if upgrade['object'] != None:
+        ob = bpy.data.objects.get(upgrade['object'])
+        if ob == None:
+            return  # deleted meanwhile
+
+    curve_minval = 0.0
+    curve_maxval = 1.0
+    texture_image = None
+    image_texture_filename = None
+    if upgrade['rad']:
+        image_texture_filename = get_16bit_texture_image(rover, sol, product_id)
+        if image_texture_filename != None:
+            texture_image = create_rad_texture_image(image_texture_filename, upgrade['rad_stretch'], upgrade['rad_png'])
+            if texture_image == None:
+                image_texture_filename = None
+    if image_texture_filename == None:
+        image_texture_filename = get_texture_image(rover, sol, product_id)
+
+    image_depth_filename = get_depth_image(rover, sol, product_id)
+    if image_depth_filename == None:
+        print(' >>>>>>> ERROR <<<<<<<<< XYZ file not found for id:', product_id)
+        return
+
+    geometry = upgrade['geometry']
+    if ob == None:
+        create_mesh_from_depthimage(rover, sol, image_depth_filename, image_texture_filename, upgrade['fill'], upgrade['rad'],
+                                    texture_image, geometry, upgrade['lod_levels'], upgrade['lod_distance'], upgrade['intensity'])
+        return
+
+    geometry = dict(DEFAULT_GEOMETRY, **geometry)
+    geometry['fill'] = bool(upgrade['fill'])
+    label, mesh_arrays, product = get_mesh_arrays(image_depth_filename, geometry)
+    if label is None:
+        return
+    del product
+
+    old_mesh = ob.data
+    name = old_mesh.name
+    mesh = create_mesh_from_arrays(name, mesh_arrays, tuple(ob.location))
+
+    if geometry['points']:
+        if upgrade['intensity']:
+            image = load_texture({'texture_image': texture_image, 'texture': image_texture_filename})
+            if image != None:
+                add_mesh_attribute(mesh, 'intensity', 'POINT', sample_image_intensity(image, mesh_arrays['point_uvs']))
+    elif texture_image != None and bpy.context.scene.render.engine in {'CYCLES', 'BLENDER_EEVEE', 'BLENDER_OPENGL'}:
+        mesh.materials.append(create_cycles_material(bpy.context, texture_image))
+    else:
+        # the browse texture of the preview is the full texture
+        for material in old_mesh.materials:
+            mesh.materials.append(material)
+
+    ob.data = mesh
+    bpy.data.meshes.remove(old_mesh)
+    mesh.name = name
+
+    camera = bpy.data.objects.get(upgrade['camera'] or '')
+    if upgrade['lod_levels'] > 0 and camera != None:
+        add_lod_objects(ob, ob.users_collection[0], image_depth_filename, geometry, upgrade['lod_levels'],
+                        upgrade['lod_distance'] * 0.1, camera)
+
+    redraw_now()
+
+
+def voxel_keys(positions, voxel_size):
+    # One int64 key per position from its voxel cell, 21 bits per axis. Returns (keys, cells)
+    cells = np.floor(positions / voxel_size).astype(np.int64) + (1 << 20)
+    np.clip(cells, 0, (1 << 21) - 1, out=cells)
+    keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+    return keys, cells
+
+
+def voxel_owners(positions_list, origins, voxel_size):
+    # Every voxel occupied by some product is owned by the product whose origin is nearest
+    # to the voxel centre; equal distances (same rover position) go to the earlier product.
+    # Returns one bool array per product, True for its vertices in voxels it owns.
+    product_voxels = []
+    keys, distances, products = [], [], []
+    for i, (positions, origin) in enumerate(zip(positions_list, origins)):
+        k, cells = voxel_keys(positions, voxel_size)
+        # rank the occupied voxels of each product, not every sample
+        k, first, inverse = np.unique(k, return_index=True, return_inverse=True)
+        centres = (cells[first] - (1 << 20) + 0.5) * voxel_size
+        product_voxels.append((k, inverse.ravel()))
+        keys.append(k)
+        distances.append(np.linalg.norm(centres - origin, axis=1))
+        products.append(np.full(len(k), i, dtype=np.int32))
+
+    keys = np.concatenate(keys)
+    products = np.concatenate(products)
+    order = np.lexsort((products, np.concatenate(distances), keys))
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    voxel_key = keys[first]
+    voxel_owner = products[order][first]
+
+    return [(voxel_owner[np.searchsorted(voxel_key, k)] == i)[inverse]
+            for i, (k, inverse) in enumerate(product_voxels)]
+
+
+def select_owned(mesh_arrays, owned):
+    # Owned points, or the faces with at least one owned corner so that no crack opens
+    # along the seams between products; unused vertices are dropped
+    if 'faces' not in mesh_arrays:
+        keep = np.flatnonzero(owned)
+        return {name: array[keep] for name, array in mesh_arrays.items()}
+
+    faces = mesh_arrays['faces']
+    corners = faces.shape[1]
+    keep = owned[faces].any(axis=1)
+    faces = faces[keep]
+    uvs = mesh_arrays['uvs'].reshape(-1, corners, 2)[keep].reshape(-1, 2)
+
+    count = len(mesh_arrays['positions'])
+    used = np.zeros(count, dtype=bool)
+    used[faces.ravel()] = True
+    remap = np.flatnonzero(used).astype(np.int32)
+    new_index = np.full(count, -1, dtype=np.int32)
+    new_index[remap] = np.arange(len(remap), dtype=np.int32)
+
+    return {'positions': mesh_arrays['positions'][remap], 'faces': new_index[faces], 'uvs': uvs,
+            'remap': mesh_arrays['remap'][remap]}
+
+
+def merge_mesh_arrays(parts):
+    # Concatenate mesh arrays; faces get the index of their part as material index
+    merged = {'positions': np.concatenate([part['positions'] for part in parts])}
+    if 'faces' not in parts[0]:
+        merged['point_uvs'] = np.concatenate([part['point_uvs'] for part in parts])
+        return merged
+
+    offsets = np.cumsum([0] + [len(part['positions']) for part in parts[:-1]])
+    merged['faces'] = np.concatenate([part['faces'] + offset for part, offset in zip(parts, offsets)])
+    merged['uvs'] = np.concatenate([part['uvs'] for part in parts])
+    merged['material_indices'] = np.concatenate([np.full(len(part['faces']), i, dtype=np.int32)
+                                                 for i, part in enumerate(parts)])
+    return merged
+
+
+def load_texture(product):
+    # Texture image of a batch product, None if there is none
+    texture_image = product['texture_image']
+    if texture_image == None and product['texture'] != None:
+        try:
+            texture_image = bpy.data.images.load(product['texture'], check_existing=True)
+            texture_image.pack()
+        except (IOError, RuntimeError):
+            print('Oh dear. Problems with %s' %(product['texture']))
+    return texture_image
+
+
+def group_products(products, group):
+    # Batch products by rover sol (group 'SOL') or site (group 'SITE'): list of (name, products)
+    groups = {}
+    for product in products:
+        if group == 'SITE':
+            fields = parse_product_id(product['product_id']) or {}
+            name = '%s-Site%s' %(product['sol'], fields.get('site'))
+            key = (product['rover'], fields.get('site'))
+        else:
+            name = '%s-Joined' %(product['sol'])
+            key = (product['rover'], product['sol'])
+        groups.setdefault(key, (name, []))[1].append(product)
+    return list(groups.values())
+
+
+def create_joined_objects(products, do_fill, geometry, group, voxel_size=0.0, point_intensity=False):
+    # One object per rover sol or site of the batch products
+    for name, group_products in group_products(products, group):
+        create_joined_object(name, group_products, do_fill, geometry, voxel_size, point_intensity)
+
+
+def create_joined_object(name, products, do_fill, geometry=None, voxel_size=0.0, point_intensity=False):
+    # Concatenate the products into one mesh built in one go. Products are ranked by product id
+    # so the result does not depend on the batch order; the material index of a face and the
+    # 'product' point attribute give the rank, the 'products' object property lists the ids.
+    # With voxel_size (metres) overlaps are removed first, see voxel_owners(); that needs
+    # products of one site, which share a frame.
+    global curve_minval, curve_maxval
+
+    geometry = dict(DEFAULT_GEOMETRY, **(geometry or {}))
+    geometry['fill'] = bool(do_fill)
+    products = sorted(products, key=lambda product: product['product_id'])
+
+    print('Joining %d products into %s...' %(len(products), name))
+
+    parts = []
+    for product in products:
+        label, mesh_arrays, unused = get_mesh_arrays(product['depth'], geometry)
+        if label is None:
+            continue
+        origin = label.ORIGIN_OFFSET_VECTOR or (0.0, 0.0, 0.0)
+        product['origin'] = rover_to_blender(np.asarray(origin, dtype=np.float32).reshape(3, 1, 1))[0]
+        parts.append((product, mesh_arrays))
+    if len(parts) == 0:
+        return
+
+    if voxel_size > 0.0:
+        owned = voxel_owners([mesh_arrays['positions'] for product, mesh_arrays in parts],
+                             [product['origin'] for product, mesh_arrays in parts], voxel_size * 0.1)
+        before = sum(len(mesh_arrays['positions']) for product, mesh_arrays in parts)
+        parts = [(product, select_owned(mesh_arrays, keep)) for (product, mesh_arrays), keep in zip(parts, owned)]
+        print('Mosaic vertices: %d of %d' %(sum(len(mesh_arrays['positions']) for product, mesh_arrays in parts), before))
+    merged = merge_mesh_arrays([mesh_arrays for product, mesh_arrays in parts])
+
+    first = parts[0][0]
+    if len(merged['positions']):
+        center = merged['positions'].mean(axis=0, dtype=np.float64)
+    else:
+        center = np.zeros(3)
+    mesh = create_mesh_from_arrays(name, merged, center)
+
+    add_mesh_attribute(mesh, 'product', 'POINT', np.concatenate(
+        [np.full(len(mesh_arrays['positions']), i, dtype=np.int32) for i, (product, mesh_arrays) in enumerate(parts)]))
+
+    ob_new = bpy.data.objects.new(mesh.name, mesh)
+    ob_new.location = center.tolist()
+    ob_new['products'] = [product['product_id'] for product, mesh_arrays in parts]
+    theSolCollection = get_collection('Sol%s' %(first['sol']))
+    theSolCollection.objects.link(ob_new)
+    ob_new.select_set(state=True)
+    bpy.context.view_layer.objects.active = ob_new
+
+    if geometry['points']:
+        if point_intensity:
+            intensity = []
+            for product, mesh_arrays in parts:
+                texture_image = load_texture(product)
+                if texture_image == None:
+                    intensity.append(np.zeros(len(mesh_arrays['positions']), dtype=np.float32))
+                else:
+                    intensity.append(sample_image_intensity(texture_image, mesh_arrays['point_uvs']))
+            add_mesh_attribute(mesh, 'intensity', 'POINT', np.concatenate(intensity))
+    else:
+        # one material slot per product, in the order of the material indices
+        engine = bpy.context.scene.render.engine
+        for product, mesh_arrays in parts:
+            material = None
+            texture_image = load_texture(product)
+            if texture_image != None and engine in {'CYCLES', 'BLENDER_EEVEE', 'BLENDER_OPENGL'}:
+                curve_minval, curve_maxval = product['curve']
+                material = create_cycles_material(bpy.context, texture_image)
+            mesh.materials.append(material)
+
+    add_rover_camera('Cam-' + name, Vector(first['origin'].tolist()), ob_new, theSolCollection)
+
+
+def rasterize_samples(xyz, valid, cell_size, max_range=0.0, origin=None):
+    # DEM cell keys and heights (-z, metres) of the valid samples of a (3, lines, samples)
+    # site frame array: row floor(x / cell_size), column floor(y / cell_size), 31 bits each
+    if max_range > 0.0:
+        valid = valid & (sample_ranges(xyz, origin) <= max_range)
+    rows = np.floor(xyz[0][valid] / cell_size).astype(np.int64) + (1 << 30)
+    columns = np.floor(xyz[1][valid] / cell_size).astype(np.int64) + (1 << 30)
+    return (rows << 32) | columns, -xyz[2][valid]
+
+
+# samples kept per DEM cell between products for the median, see thin_cells()
+DEM_MEDIAN_SAMPLES = 32
+
+
+def reduce_cells(keys, heights, rule='TOP', weights=None):
+    # One height per distinct cell key: the highest ('TOP', a z-buffer looking down) or the
+    # median of the samples ('MEDIAN'), weighted by weights when given, see thin_cells().
+    # Returns (keys, heights), sorted by key
+    if len(keys) == 0:
+        return keys, heights
+
+    if rule == 'MEDIAN':
+        order = np.lexsort((heights, keys))
+    else:
+        order = np.argsort(keys)
+    keys = keys[order]
+    heights = heights[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+    if rule == 'MEDIAN':
+        if weights is None:
+            weights = np.ones(len(keys))
+        else:
+            weights = weights[order]
+        # mean of the lower and upper weighted medians: with unit weights, the middle sample
+        # or the mean of the two middle ones
+        counts = np.diff(np.append(starts, len(keys)))
+        cumulative = np.cumsum(weights)
+        within = cumulative - np.repeat(cumulative[starts] - weights[starts], counts)
+        half = np.repeat(np.add.reduceat(weights, starts) * 0.5, counts)
+        lower = starts + np.add.reduceat((within < half).astype(np.int64), starts)
+        upper = starts + np.add.reduceat((within <= half).astype(np.int64), starts)
+        values = 0.5 * (heights[lower] + heights[upper])
+    else:
+        values = np.maximum.reduceat(heights, starts)
+    return keys[starts], values
+
+
+def thin_cells(keys, heights, weights, limit=DEM_MEDIAN_SAMPLES):
+    # Bound the samples kept per cell for the median: those of a cell with more than limit
+    # samples are merged, in height order, into limit runs, each one kept as its mean height
+    # and total weight. Runs are shorter towards the middle weight of the cell, so samples
+    # near the median stay apart. Cells with fewer samples keep them as is.
+    # Returns (keys, heights, weights)
+    if len(keys) == 0:
+        return keys, heights, weights
+
+    order = np.lexsort((heights, keys))
+    keys, heights, weights = keys[order], heights[order], weights[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys)))
+    cell = np.repeat(np.arange(len(starts)), counts)
+
+    # run of every sample: its rank, or for crowded cells the run of its weight quantile,
+    # runs spanning quantiles 0.5 +- 2 * (i / limit - 0.5)^2
+    before = np.cumsum(weights) - weights
+    before -= before[starts][cell]
+    total = np.add.reduceat(weights, starts)[cell]
+    middle = (before + 0.5 * weights) / total - 0.5
+    stretched = 0.5 + np.sign(middle) * np.sqrt(np.abs(middle) * 0.5)
+    quantile = np.minimum((stretched * limit).astype(np.int64), limit - 1)
+    rank = np.arange(len(keys)) - starts[cell]
+    run = np.where(counts[cell] > limit, quantile, rank)
+
+    runs = np.flatnonzero(np.concatenate(([True], (cell[1:] != cell[:-1]) | (run[1:] != run[:-1]))))
+    run_weights = np.add.reduceat(weights, runs)
+    run_heights = np.add.reduceat(heights * weights, runs) / run_weights
+    return keys[runs], run_heights, run_weights
+
+
+def build_dem(products, geometry, cell_size, rule='TOP'):
+    # Site frame DEM of the products: (dem, row0, column0) with dem a (rows, columns) float32
+    # height array, NaN for empty cells; cell (j, k) covers x from (row0 + j) * cell_size and
+    # y from (column0 + k) * cell_size. Highest samples are reduced per block, so only one
+    # value per covered cell is kept between blocks; for the median, at most
+    # DEM_MEDIAN_SAMPLES weighted samples per cell, see thin_cells(). Either way the memory
+    # scales with the terrain area, not the sample count.
+    keys, heights, weights = [], [], []
+    kept = 0  # samples of the median after the last thin_cells()
+    for product in products:
+        if decode_block_lines > 0:
+            label, xyz, valid = open_depth_product(product['depth'])
+        else:
+            label, xyz, valid = load_depth_product(product['depth'])
+        if label is None:
+            continue
+
+        # whole product, or decode_block_lines at a time
+        lines = xyz.shape[1]
+        step = decode_block_lines or lines
+        for start in range(0, lines, step):
+            if decode_block_lines > 0:
+                block, block_valid = read_xyz_block(xyz, valid, start, start + step)
+            else:
+                block, block_valid = xyz, valid
+            block_keys, block_heights = rasterize_samples(block, block_valid, cell_size, geometry['max_range'],
+                                                          label.ORIGIN_OFFSET_VECTOR)
+            del block, block_valid
+            if rule != 'MEDIAN':
+                block_keys, block_heights = reduce_cells(block_keys, block_heights, rule)
+                keys.append(block_keys)
+                heights.append(block_heights)
+                continue
+
+            keys.append(block_keys)
+            heights.append(block_heights.astype(np.float64))
+            weights.append(np.ones(len(block_keys)))
+            # thin once the new samples outnumber the kept ones, so each one is sorted a few times only
+            if sum(len(k) for k in keys) > 2 * kept:
+                thinned = thin_cells(np.concatenate(keys), np.concatenate(heights), np.concatenate(weights))
+                keys, heights, weights = [[array] for array in thinned]
+                kept = len(thinned[0])
+        del xyz, valid
+    if len(keys) == 0:
+        return None, 0, 0
+
+    if rule == 'MEDIAN':
+        keys, heights = reduce_cells(np.concatenate(keys), np.concatenate(heights), rule, np.concatenate(weights))
+    else:
+        keys, heights = reduce_cells(np.concatenate(keys), np.concatenate(heights), rule)
+    if len(keys) == 0:
+        return None, 0, 0
+    rows = (keys >> 32) - (1 << 30)
+    columns = (keys & 0xffffffff) - (1 << 30)
+    row0, column0 = rows.min(), columns.min()
+
+    dem = np.full((rows.max() - row0 + 1, columns.max() - column0 + 1), np.nan, dtype=np.float32)
+    dem[rows - row0, columns - column0] = heights
+    return dem, int(row0), int(column0)
+
+
+def create_heightfield(name, dem, row0, column0, cell_size):
+    # Float image of the heights above the lowest cell (Blender units, empty cells at 0) and a
+    # plane displaced by it through simple subdivision. DEM rows run along Blender Y (site x),
+    # columns along Blender X (site y), the image bottom row being the first DEM row.
+    rows, columns = dem.shape
+    lowest = np.nanmin(dem)
+    heights = np.nan_to_num((dem - lowest) * 0.1, nan=0.0)
+
+    image = bpy.data.images.new(name, width=columns, height=rows, alpha=False, float_buffer=True)
+    pixels = np.empty((rows, columns, 4), dtype=np.float32)
+    pixels[:, :, :3] = heights[:, :, np.newaxis]
+    pixels[:, :, 3] = 1.0
+    image.pixels.foreach_set(pixels.ravel())
+
+    # keep the float heights with the blend file
+    filename = os.path.join(local_data_dir, name + '.exr')
+    try:
+        image.filepath_raw = filename
+        image.file_format = 'OPEN_EXR'
+        image.save()
+    except (RuntimeError, IOError, OSError) as e:
+        print('Unable to save heightfield %s: %s' %(filename, e))
+
+    # plane over the DEM extent, cell edges included
+    x0, y0 = column0 * cell_size * 0.1, row0 * cell_size * 0.1
+    x1, y1 = x0 + columns * cell_size * 0.1, y0 + rows * cell_size * 0.1
+    plane_arrays = {'positions': np.array([(x0, y0, 0.0), (x1, y0, 0.0), (x1, y1, 0.0), (x0, y1, 0.0)], dtype=np.float32),
+                    'faces': np.array([(0, 1, 2, 3)], dtype=np.int32),
+                    'uvs': np.array([(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)], dtype=np.float32)}
+    center = ((x0 + x1) * 0.5, (y0 + y1) * 0.5, lowest * 0.1)
+    mesh = create_mesh_from_arrays(name, plane_arrays, center)
+
+    ob = bpy.data.objects.new(mesh.name, mesh)
+    ob.location = center
+
+    levels = min(10, int(math.ceil(math.log(max(rows, columns, 2), 2))))
+    subdivision = ob.modifiers.new('Subdivision', 'SUBSURF')
+    subdivision.subdivision_type = 'SIMPLE'
+    subdivision.levels = levels
+    subdivision.render_levels = levels
+
+    texture = bpy.data.textures.new(name, type='IMAGE')
+    texture.image = image
+    texture.extension = 'EXTEND'
+    displace = ob.modifiers.new('Displace', 'DISPLACE')
+    displace.texture = texture
+    displace.texture_coords = 'UV'
+    displace.mid_level = 0.0
+    displace.strength = 1.0
+    return ob
+
+
+def create_site_dems(products, do_fill, geometry, output='MESH', cell_size=0.1, rule='TOP'):
+    # One DEM per rover site of the batch products
+    for name, site_products in group_products(products, 'SITE'):
+        create_site_dem(name + '-DEM', site_products, do_fill, geometry, output, cell_size, rule)
+
+
+def create_site_dem(name, products, do_fill, geometry=None, output='MESH', cell_size=0.1, rule='TOP'):
+    # Rasterize the products of one site into a DEM of cell_size metres, see build_dem(), then
+    # create a displaced heightfield plane (output 'IMAGE') or a grid mesh (output 'MESH').
+    # The grid mesh takes the fill, resolution, tolerance and edge options of geometry.
+    geometry = dict(DEFAULT_GEOMETRY, **(geometry or {}))
+    geometry['fill'] = bool(do_fill)
+    products = sorted(products, key=lambda product: product['product_id'])
+
+    print('Creating DEM of %d products, cell %g m...' %(len(products), cell_size))
+    dem, row0, column0 = build_dem(products, geometry, cell_size, rule)
+    if dem is None:
+        print('No XYZ samples for %s' %(name))
+        return
+    print('DEM size: %d x %d' %(dem.shape[1], dem.shape[0]))
+
+    if output == 'IMAGE':
+        ob_new = create_heightfield(name, dem, row0, column0, cell_size)
+    else:
+        # the DEM as a (3, rows, columns) xyz grid at the cell centres
+        rows, columns = dem.shape
+        xyz = np.empty((3, rows, columns), dtype=np.float32)
+        xyz[0] = ((np.arange(rows) + row0 + 0.5) * cell_size)[:, np.newaxis]
+        xyz[1] = ((np.arange(columns) + column0 + 0.5) * cell_size)[np.newaxis, :]
+        xyz[2] = -dem
+        valid = np.isfinite(dem)
+        xyz[2][~valid] = 0.0
+
+        # samples are already cut at max_range, a depth ratio means nothing on a grid seen from above
+        dem_geometry = dict(geometry, max_range=0.0, max_depth_ratio=0.0)
+        mesh_arrays = build_mesh_arrays(xyz, valid, dem_geometry)
+        del xyz, valid
+        if len(mesh_arrays['positions']):
+            center = mesh_arrays['positions'].mean(axis=0, dtype=np.float64)
+        else:
+            center = np.zeros(3)
+        mesh = create_mesh_from_arrays(name, mesh_arrays, center)
+        ob_new = bpy.data.objects.new(mesh.name, mesh)
+        ob_new.location = center.tolist()
+
+    ob_new['products'] = [product['product_id'] for product in products]
+    theSolCollection = get_collection('Sol%s' %(products[0]['sol']))
+    theSolCollection.objects.link(ob_new)
+    ob_new.select_set(state=True)
+    bpy.context.view_layer.objects.active = ob_new
+
+
+def add_rover_camera(name, rover_vec, obj, collection):
+    # Scene camera above the rover origin (rover_vec, Blender units) looking at obj
+    cam = bpy.data.cameras.new('Camera')
+    cam.lens = 40
+    cam.clip_start = 0.01
+    cam_ob = bpy.data.objects.new(name, cam)
+
+    mat_loc = mathutils.Matrix.Translation(rover_vec)
+    mat_trans = mathutils.Matrix.Translation((0.0, 0.0, 0.15))
+
+    cam_ob.matrix_world = mat_loc @ mat_trans
+
+    objloc = Vector(obj.location)
+    rovloc = Vector(rover_vec)
+    distvec = rovloc - objloc
+
+    expoint = obj.matrix_world.to_translation()+Vector((0.0, 0.0, -0.04-distvec.length*0.1))
+    look_at(cam_ob, expoint)
+
+    collection.objects.link(cam_ob)
+    bpy.context.scene.camera = cam_ob
+    return cam_ob
+
 
 def look_at(obj_camera, point):
     loc_camera = obj_camera.matrix_world.to_translation()
@@ -1356,12 +3446,17 @@ def register():
     bpy.utils.register_class(NavcamDialogOperator)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.utils.register_class(ROVER_PT_NavcamToolsPanel)
+    bpy.app.handlers.depsgraph_update_post.append(update_lod_visibility)
+    bpy.app.handlers.frame_change_post.append(update_lod_visibility)
 
 
 def unregister():
     bpy.utils.unregister_class(NavcamDialogOperator)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
     bpy.utils.unregister_class(ROVER_PT_NavcamToolsPanel)
+    for handlers in (bpy.app.handlers.depsgraph_update_post, bpy.app.handlers.frame_change_post):
+        if update_lod_visibility in handlers:
+            handlers.remove(update_lod_visibility)
 
 def ShowMessageBox(message = "", title = "Message Box", icon = 'INFO'):
 